@@ -0,0 +1,199 @@
+# !/usr/bin/env python
+
+"""
+author   : Marcelo Sanches
+doc name : Asynchronous Kafka consumer pipeline
+purpose  : to poll, decode, transform and bulk-load baskets concurrently, keeping several
+           bulk requests to Elasticsearch in flight from a single consumer process
+date     : 05.07.2019
+version  : 3.7.2
+"""
+
+# Import modules
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from confluent_kafka import KafkaError, KafkaException, TopicPartition
+from KafkaConsumer import (transform_msg, load_bulk_retry, update_model, record_lag, read_msg,
+                           msg_id, baskets_consumed, etl_time, BULK_RETRY_TIME)
+
+
+# Setup classes
+class basketBatch():
+    """This class holds a batch of baskets and their document ids with its sequence number
+       and, for each topic partition, the offset to commit once the batch is acknowledged.
+    """
+
+    def __init__(self, seq):
+        self.seq = seq
+        self.msgs = []
+        self.ids = []
+        self.offsets = {}
+
+
+class offsetTracker():
+    """This class commits offsets in batch order: a batch acknowledged by Elasticsearch is
+       only committed once every batch before it has been acknowledged as well.
+    """
+
+    def __init__(self):
+        self.next_seq = 0
+        self.acked = {}
+        self.docs_indexed = 0
+        self.start_time = time.time()
+
+    def ack(self, batch):
+        """Records an acknowledged batch and returns the offsets that can now be committed,
+           or None while an earlier batch is still in flight.
+        """
+        self.acked[batch.seq] = batch
+        offsets = {}
+        while self.next_seq in self.acked:
+            done = self.acked.pop(self.next_seq)
+            offsets.update(done.offsets)
+            self.docs_indexed += len(done.msgs)
+            self.next_seq += 1
+
+        return offsets or None
+
+
+class asyncPipeline():
+    """This class runs the consumer as four asyncio stages connected by bounded queues:
+       poll -> decode -> transform/batch -> bulk-send. Blocking Kafka and Elasticsearch
+       calls run in thread pools; when the queues fill up, polling waits, which applies
+       backpressure to Kafka.
+    """
+
+    def __init__(self, consumer, batch_size=500, linger_ms=1000, concurrency=4, queue_size=10000,
+                 model=None):
+        self.consumer = consumer
+        self.model = model
+        self.batch_size = batch_size
+        self.linger = linger_ms / 1000.0
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.tracker = offsetTracker()
+
+        # the consumer is only ever used from one thread; bulk requests get their own pool
+        self.kafka_executor = ThreadPoolExecutor(max_workers=1)
+        self.es_executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def poll(self, decode_queue):
+        """Polls Kafka in batches of messages, waiting whenever the decode queue is full.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            msgs = await loop.run_in_executor(self.kafka_executor, self.consumer.consume,
+                                              self.batch_size, 0.5)
+            for msg in msgs:
+                if msg.error():
+                    if msg.error().code() == KafkaError._PARTITION_EOF:
+                        continue
+                    else:
+                        raise KafkaException(msg.error())
+                await decode_queue.put(msg)
+
+    async def decode(self, decode_queue, transform_queue):
+        """Decodes message bytes into baskets (unless they can be indexed as they are),
+           keeping each message's partition and offset.
+        """
+        while True:
+            msg = await decode_queue.get()
+            basket = read_msg(msg, self.model)
+            await transform_queue.put((basket, msg_id(msg, basket), msg.topic(), msg.partition(),
+                                       msg.offset()))
+
+    async def transform(self, transform_queue, send_queue):
+        """Reshapes baskets into ES-friendly format and groups them into batches, sending a
+           batch on once it is full or has waited for the linger time.
+        """
+        seq = 0
+        while True:
+            batch = basketBatch(seq)
+            deadline = None
+            while len(batch.msgs) < self.batch_size:
+                timeout = None if deadline is None else max(0, deadline - time.time())
+                try:
+                    basket, doc_id, topic, partition, offset = await asyncio.wait_for(
+                        transform_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if deadline is None:
+                    deadline = time.time() + self.linger
+                if isinstance(basket, dict):
+                    transform_msg(basket)
+                batch.msgs.append(basket)
+                batch.ids.append(doc_id)
+                batch.offsets[(topic, partition)] = offset + 1
+
+            await send_queue.put(batch)
+            seq += 1
+
+    async def send(self, send_queue):
+        """Flings batches into Elasticsearch through the _bulk API, retrying a batch while
+           Elasticsearch is unavailable, and commits, in order, the offsets of every batch 
+           that has been acknowledged.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await send_queue.get()
+            start = time.perf_counter()
+            if not await loop.run_in_executor(self.es_executor, load_bulk_retry, batch.msgs,
+                                              batch.ids):
+                raise Exception("Elasticsearch did not accept batch " + str(batch.seq)
+                                + " after retrying for " + str(BULK_RETRY_TIME) 
+                                + " s, offsets not committed")
+            etl_time.observe(time.perf_counter() - start, mode='async')
+            baskets_consumed.inc(len(batch.msgs))
+            update_model(self.model, batch.msgs, batch.ids)
+
+            # the model resumes from offsets below which every batch has been counted
+            offsets = self.tracker.ack(batch)
+            if offsets is not None:
+                update_model(self.model, [], offsets=offsets)
+                await loop.run_in_executor(self.kafka_executor, self.commit, offsets,
+                                           self.tracker.docs_indexed)
+
+    def commit(self, offsets, docs_indexed):
+        """Commits offsets synchronously and reports the throughput so far.
+        """
+        self.consumer.commit(offsets=[TopicPartition(topic, partition, offset)
+                                      for (topic, partition), offset in offsets.items()],
+                             asynchronous=False)
+        record_lag(self.consumer, offsets)
+        elapsed = time.time() - self.tracker.start_time
+        print("committed " + str(docs_indexed) + " baskets, "
+              + str(round(docs_indexed / elapsed, 1)) + " docs/sec")
+
+    async def run(self):
+        """Runs all stages until one of them fails.
+        """
+        decode_queue = asyncio.Queue(self.queue_size)
+        transform_queue = asyncio.Queue(self.queue_size)
+
+        # at most one batch waits for each sender, so polling stops when ES falls behind
+        send_queue = asyncio.Queue(self.concurrency)
+
+        tasks = [asyncio.ensure_future(self.poll(decode_queue)),
+                 asyncio.ensure_future(self.decode(decode_queue, transform_queue)),
+                 asyncio.ensure_future(self.transform(transform_queue, send_queue))]
+        tasks += [asyncio.ensure_future(self.send(send_queue)) for i in range(self.concurrency)]
+
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.es_executor.shutdown(wait=False)
+            self.kafka_executor.shutdown(wait=False)
+
+
+# Setup functions
+def consume_async(c, batch_size=500, linger_ms=1000, concurrency=4, model=None):
+    """Consumes the stream with the asynchronous pipeline, keeping up to concurrency bulk
+       requests in flight.
+    """
+    pipeline = asyncPipeline(c, batch_size, linger_ms, concurrency, model=model)
+    asyncio.run(pipeline.run())
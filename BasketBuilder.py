@@ -0,0 +1,127 @@
+# !/usr/bin/env python
+
+"""
+author   : Marcelo Sanches
+doc name : Basket builder
+purpose  : to aggregate Online Retail rows into per-invoice baskets in one columnar pass
+date     : 05.06.2019
+version  : 3.7.2
+"""
+
+# Import modules
+import calendar
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+# fields that are the same for each row of an invoice
+BASKET_FIELDS = ['InvoiceNo', 'CustomerID', 'InvoiceDate', 'Country']
+
+# fields that are different for each row of an invoice, appended to lists
+BASKET_LISTS = [('StockCode', 'StockCodes'),
+                ('Description', 'Descriptions'),
+                ('Quantity', 'Quantities'),
+                ('UnitPrice', 'UnitPrices')]
+
+
+# Setup functions
+@lru_cache(maxsize=65536)
+def get_timestamp(date_element):
+    """Transform InvoiceDate into an Elasticsearch-friendly timestamp in milliseconds.
+       Dates are read as UTC, like a naive pd.Timestamp, and results are cached since many 
+       invoices share the same date string.
+    """
+    date, time = date_element.split()
+    year, month, day = date.split('-')
+    hours, mins, secs = time.split(':')
+
+    return calendar.timegm((int(year), int(month), int(day), 
+                            int(hours), int(mins), int(secs))) * 1000
+
+def epoch_millis(dates):
+    """Vectorized get_timestamp: converts a column of dates (strings or datetimes) into 
+       integer milliseconds since the epoch, reading naive dates as UTC.
+    """
+    dates = pd.to_datetime(dates)
+
+    return (dates - pd.Timestamp('1970-01-01')) // pd.Timedelta(milliseconds=1)
+
+def invoice_boundaries(df):
+    """Sorts rows by InvoiceNo (keeping the original row order within each invoice, as
+       groupby does) and returns the sorted dataframe with start and end positions of
+       each invoice.
+    """
+    df = df.sort_values('InvoiceNo', kind='mergesort')
+    invoices = df['InvoiceNo'].to_numpy()
+
+    # an invoice starts wherever the invoice number changes
+    starts = np.flatnonzero(np.r_[True, invoices[1:] != invoices[:-1]])
+    ends = np.r_[starts[1:], len(invoices)]
+
+    return df, starts, ends
+
+def build_baskets(df, timestamps=False):
+    """Turns a dataframe of Online Retail rows into basket dictionaries, one per invoice,
+       in the same order and with the same content as grouping by InvoiceNo and iterating
+       over rows. With timestamps=True, the InvoiceDate of each basket is replaced by its
+       Elasticsearch timestamp, converted for the whole column at once.
+    """
+    if len(df) == 0:
+        return
+
+    df, starts, ends = invoice_boundaries(df)
+
+    # convert each column to Python objects once instead of once per row
+    fields = {name: df[name].tolist() for name in BASKET_FIELDS}
+    lists = {name: df[column].tolist() for column, name in BASKET_LISTS}
+
+    if timestamps:
+        del fields['InvoiceDate']
+        stamps = epoch_millis(df['InvoiceDate']).tolist()
+
+    # parsed dates (e.g. from the Parquet cache) are shipped in the same format as the CSV
+    elif pd.api.types.is_datetime64_any_dtype(df['InvoiceDate']):
+        fields['InvoiceDate'] = df['InvoiceDate'].dt.strftime('%Y-%m-%d %H:%M:%S').tolist()
+
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        basket = {}
+
+        # same for each row, keep the last row's value as the row loop did
+        for name in fields:
+            basket[name] = fields[name][end - 1]
+
+        for name in lists:
+            basket[name] = lists[name][start:end]
+
+        # the timestamp goes last, where ETL_msg used to add it
+        if timestamps:
+            basket['timestamp'] = stamps[end - 1]
+
+        yield basket
+
+def stream_baskets(chunks, timestamps=False):
+    """Turns an iterable of dataframe chunks into baskets as the chunks arrive. The rows of
+       an invoice are expected to be contiguous, as in the Online Retail files, so only the
+       rows of the last invoice of each chunk are held back (it may continue in the next
+       chunk) and memory stays bounded by the chunk size. Within a chunk, baskets come out
+       in invoice order, as with build_baskets.
+    """
+    carry = None
+    for chunk in chunks:
+        if carry is not None and len(carry):
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        if len(chunk) == 0:
+            continue
+
+        # rows after the last change of invoice number belong to a possibly incomplete basket
+        invoices = chunk['InvoiceNo'].to_numpy()
+        changes = np.flatnonzero(invoices != invoices[-1])
+        tail = changes[-1] + 1 if len(changes) else 0
+
+        for basket in build_baskets(chunk.iloc[:tail], timestamps):
+            yield basket
+        carry = chunk.iloc[tail:]
+
+    if carry is not None:
+        for basket in build_baskets(carry, timestamps):
+            yield basket
@@ -0,0 +1,151 @@
+# !/usr/bin/env python
+
+"""
+author   : Marcelo Sanches
+doc name : Kafka consumer group runner
+purpose  : to run one bulk-indexing consumer process per topic partition, all in the same
+           consumer group, and report their combined throughput
+date     : 05.07.2019
+version  : 3.7.2
+"""
+
+# Import modules
+import argparse
+import multiprocessing
+import signal
+import time
+from confluent_kafka import Consumer, KafkaError, KafkaException
+from confluent_kafka.admin import AdminClient
+from KafkaConsumer import recommender_system_topic, consumer_config, basketBatcher
+import ElasticsearchClient
+from ElasticsearchClient import check_index
+
+
+# Setup functions
+def count_partitions(topic, default=3):
+    """Returns the number of partitions of a Kafka topic, or a default if the topic metadata
+       is not available.
+    """
+    admin = AdminClient({'bootstrap.servers': consumer_config['bootstrap.servers']})
+    try:
+        metadata = admin.list_topics(topic, timeout=10).topics[topic]
+    except Exception as e:
+        print("Error reading topic metadata: " + str(e))
+        return default
+    if metadata.error is not None or not metadata.partitions:
+        return default
+
+    return len(metadata.partitions)
+
+def consumer_worker(worker_id, counter, batch_size, linger_ms):
+    """Consumes the topic in bulk-indexing mode until SIGTERM. Pending baskets are flushed
+       and committed whenever partitions are revoked and before shutting down.
+    """
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # a forked worker must not share the parent's pooled connections to Elasticsearch, or 
+    # concurrent requests of several workers would go over the same socket
+    ElasticsearchClient.shared_client = None
+
+    config = dict(consumer_config)
+    config['enable.auto.commit'] = False
+    c = Consumer(config)
+    batcher = basketBatcher(c, batch_size, linger_ms, report=False)
+
+    def on_assign(consumer, partitions):
+        print("worker " + str(worker_id) + " assigned partitions " 
+              + str([p.partition for p in partitions]))
+
+    def on_revoke(consumer, partitions):
+        # flush while the partitions are still ours, so the next owner starts after them
+        batcher.flush()
+        print("worker " + str(worker_id) + " revoked partitions " 
+              + str([p.partition for p in partitions]))
+
+    c.subscribe([recommender_system_topic], on_assign=on_assign, on_revoke=on_revoke)
+
+    try:
+        while not stopping:
+
+            # consume up to a full batch, waking up at least once a second to check for SIGTERM
+            msgs = c.consume(num_messages=batch_size - len(batcher.msgs), 
+                             timeout=min(batcher.timeout(), 1.0))
+
+            for msg in msgs:
+                if msg.error():
+                    if msg.error().code() == KafkaError._PARTITION_EOF:
+                        continue
+                    else:
+                        raise KafkaException(msg.error())
+                batcher.add(msg)
+
+            if batcher.is_due():
+                batcher.flush()
+                counter.value = batcher.docs_indexed
+
+        # graceful shutdown: index and commit what is left, then leave the group
+        batcher.flush()
+        counter.value = batcher.docs_indexed
+    finally:
+        c.close()
+
+def report_throughput(counters, start):
+    """Prints the combined and per-worker number of baskets indexed and the overall docs/sec.
+    """
+    counts = [counter.value for counter in counters]
+    total = sum(counts)
+    elapsed = time.time() - start
+    print("indexed " + str(total) + " baskets " + str(counts) + ", " 
+          + str(round(total / elapsed, 1)) + " docs/sec overall")
+
+
+# Run
+if __name__ == "__main__":
+    # command line options
+    parser = argparse.ArgumentParser(description="Run a group of bulk-indexing Kafka consumers")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of consumer processes (default: number of topic partitions)")
+    parser.add_argument("--batch-size", type=int, default=500,
+                        help="maximum number of baskets per bulk request (default: 500)")
+    parser.add_argument("--linger-ms", type=int, default=1000,
+                        help="maximum time a basket waits for its batch to fill up (default: 1000)")
+    parser.add_argument("--report-interval", type=float, default=10,
+                        help="seconds between throughput reports (default: 10)")
+    args = parser.parse_args()
+
+    workers = args.workers or count_partitions(recommender_system_topic)
+    print("Starting " + str(workers) + " consumer workers")
+
+    # check whether index exists, if not, create it
+    check_index("recommender_system")
+
+    # one shared counter of indexed baskets per worker
+    counters = [multiprocessing.Value('L', 0) for i in range(workers)]
+    processes = [multiprocessing.Process(target=consumer_worker, 
+                                         args=(i, counters[i], args.batch_size, args.linger_ms))
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+
+    # forward SIGTERM and Ctrl-C to the workers so they can flush and commit
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+
+    start = time.time()
+    next_report = start + args.report_interval
+    while not stopping and any(process.is_alive() for process in processes):
+        time.sleep(min(args.report_interval, 1.0))
+        if time.time() >= next_report:
+            report_throughput(counters, start)
+            next_report += args.report_interval
+
+    print("Stopping consumer workers")
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join()
+    report_throughput(counters, start)
@@ -0,0 +1,398 @@
+# !/usr/bin/env python
+
+"""
+author   : Marcelo Sanches
+doc name : Co-occurrence recommender
+purpose  : to precompute "customers who bought this also bought" lists offline from a sparse
+           item x item co-occurrence matrix and serve them from memory
+date     : 05.06.2019
+version  : 3.7.2
+"""
+
+# Import modules
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import ujson
+from ElasticsearchClient import get_client
+
+
+# Setup functions
+def significance(counts, support, n_baskets, fg_size, scoring='jlh'):
+    """Scores co-occurrences the way Elasticsearch's significant_terms does. For a query
+       item, the foreground set is the fg_size baskets containing it and the background set
+       is all n_baskets baskets; counts are the foreground baskets containing each candidate
+       item and support the background baskets containing it.
+    """
+    fg = counts / fg_size
+    bg = support / n_baskets
+
+    if scoring == 'jlh':
+        # JLH: absolute change in popularity times relative change, only for risers
+        return np.where(fg > bg, (fg - bg) * (fg / bg), 0.0)
+
+    if scoring == 'chi_square':
+        # chi-square on the 2x2 table of (in foreground, contains item), background excludes
+        # the foreground as in significant_terms with background_is_superset
+        a = counts
+        b = fg_size - counts
+        c = support - counts
+        d = (n_baskets - fg_size) - c
+        n = a + b + c + d
+        denom = (a + b) * (c + d) * (a + c) * (b + d)
+        score = np.where(denom > 0, n * (a * d - b * c)**2 / np.maximum(denom, 1), 0.0)
+        return np.where(fg > c / np.maximum(n_baskets - fg_size, 1), score, 0.0)
+
+    raise ValueError("Unknown scoring " + str(scoring))
+
+def basket_matrix(basket_ids, item_ids, n_baskets, n_items):
+    """Builds a binary basket x item matrix; an item bought several times in the same basket
+       counts once, as a term does for a document.
+    """
+    B = sp.csr_matrix((np.ones(len(basket_ids), dtype=np.int32), (basket_ids, item_ids)),
+                      shape=(n_baskets, n_items))
+    B.sum_duplicates()
+    B.data[:] = 1
+
+    return B
+
+def scroll_baskets(index='recommender_system', page_size=5000):
+    """Yields the Descriptions list of every basket in an index through the scroll API.
+    """
+    es = get_client()
+    r = es.post("/{}/_search".format(index),
+                {"size": page_size, "_source": ["Descriptions"], "sort": ["_doc"]},
+                params={"scroll": "2m"})
+    res = r.json()
+    while res["hits"]["hits"]:
+        for hit in res["hits"]["hits"]:
+            yield hit["_source"]["Descriptions"]
+        r = es.post("/_search/scroll", {"scroll": "2m", "scroll_id": res["_scroll_id"]})
+        res = r.json()
+    es.delete("/_search/scroll/" + res["_scroll_id"])
+
+
+# Setup classes
+class cooccurrenceModel():
+    """This class holds, for every product, its top-K "also bought" products with their
+       significance scores and co-occurrence counts, stored CSR-style: the neighbors of item
+       i are neighbors[offsets[i]:offsets[i + 1]], sorted by descending score.
+    """
+
+    def __init__(self, items, offsets, neighbors, scores, counts, support, n_baskets):
+        self.items = items
+        self.item_ids = {item: i for i, item in enumerate(items)}
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.scores = scores
+        self.counts = counts
+        self.support = support
+        self.n_baskets = n_baskets
+
+    @classmethod
+    def from_matrix(cls, B, items, **kwargs):
+        """Computes top-K lists from a binary basket x item matrix.
+        """
+        C = (B.T @ B).tocoo()
+        support = np.asarray(B.sum(axis=0)).ravel().astype(np.int64)
+
+        return cls.from_cooccurrence(C, support, B.shape[0], items, **kwargs)
+
+    @classmethod
+    def from_cooccurrence(cls, C, support, n_baskets, items, top_k=10, min_doc_count=10,
+                          scoring='jlh'):
+        """Computes top-K lists from an item x item co-occurrence matrix (COO format) and
+           item support, scoring every non-zero co-occurrence at once.
+        """
+        n_items = len(items)
+
+        # candidates: other items bought together at least min_doc_count times
+        keep = (C.row != C.col) & (C.data >= min_doc_count)
+        rows, cols, counts = C.row[keep], C.col[keep], C.data[keep].astype(np.int64)
+        scores = significance(counts, support[cols], n_baskets, support[rows], scoring)
+        keep = scores > 0
+        rows, cols, counts, scores = rows[keep], cols[keep], counts[keep], scores[keep]
+
+        # sort by item, then by descending score (ties by product name, so the order does not
+        # depend on item ids), and keep the first top_k of each item
+        name_rank = np.argsort(np.argsort(np.asarray(items, dtype=object)))
+        order = np.lexsort((name_rank[cols], -scores, rows))
+        rows, cols, counts, scores = rows[order], cols[order], counts[order], scores[order]
+        starts = np.searchsorted(rows, np.arange(n_items))
+        rank = np.arange(len(rows)) - starts[rows]
+        keep = rank < top_k
+        rows, cols, counts, scores = rows[keep], cols[keep], counts[keep], scores[keep]
+
+        offsets = np.zeros(n_items + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(rows, minlength=n_items))
+
+        return cls(list(items), offsets, cols.astype(np.int32), scores.astype(np.float32),
+                   counts.astype(np.int32), support, n_baskets)
+
+    @classmethod
+    def from_dataframe(cls, df, **kwargs):
+        """Builds the model from Online Retail rows (e.g. the cached Online_Retail data).
+        """
+        basket_ids, baskets = pd.factorize(df['InvoiceNo'])
+        item_ids, items = pd.factorize(df['Description'].astype(str))
+        B = basket_matrix(basket_ids, item_ids, len(baskets), len(items))
+
+        return cls.from_matrix(B, items, **kwargs)
+
+    @classmethod
+    def from_baskets(cls, baskets, **kwargs):
+        """Builds the model from lists of descriptions, one per basket (e.g. scroll_baskets).
+        """
+        basket_ids = []
+        descriptions = []
+        n_baskets = 0
+        for i, basket in enumerate(baskets):
+            basket_ids.extend([i] * len(basket))
+            descriptions.extend(basket)
+            n_baskets = i + 1
+        item_ids, items = pd.factorize(pd.Series(descriptions, dtype=object))
+        B = basket_matrix(np.asarray(basket_ids, dtype=np.int64), item_ids, n_baskets, len(items))
+
+        return cls.from_matrix(B, items, **kwargs)
+
+    def recommend(self, userinput):
+        """Returns the also-bought list of a product as [[product, count], ...], the same
+           shape as queryUserinput.user_query, or an empty list for an unknown product.
+        """
+        i = self.item_ids.get(userinput)
+        if i is None:
+            return []
+        start, end = self.offsets[i], self.offsets[i + 1]
+
+        return [[self.items[j], int(count)] for j, count
+                in zip(self.neighbors[start:end], self.counts[start:end])]
+
+
+class cooccurrenceCounts():
+    """This class keeps item support, pair counts and the number of baskets up to date as
+       baskets arrive. Baskets are buffered as item ids and folded into the counts in one
+       vectorized pass per compaction; pairs are stored as sorted int64 keys (smaller id in
+       the high 32 bits) with their counts. Baskets are counted once per id, so replays do 
+       not count them again, and snapshots record the Kafka offsets up to which every 
+       basket was counted, so that a restarted consumer can resume counting from there.
+    """
+
+    SNAPSHOT_VERSION = 2
+
+    def __init__(self, compact_every=5000, snapshot_path=None, snapshot_interval=60):
+        self.items = []
+        self.item_ids = {}
+        self.support = np.zeros(0, dtype=np.int64)
+        self.pair_keys = np.zeros(0, dtype=np.int64)
+        self.pair_counts = np.zeros(0, dtype=np.int64)
+        self.n_baskets = 0
+        self.compact_every = compact_every
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.pending_ids = []
+        self.pending_sizes = []
+        self.last_snapshot = time.time()
+        self.counted = set()
+        self.offsets = {}
+
+    def update(self, descriptions, basket_id=None):
+        """Adds one basket, given its list of descriptions, unless a basket with the same id
+           was already counted. Returns whether it was added.
+        """
+        if basket_id is not None:
+            if basket_id in self.counted:
+                return False
+            self.counted.add(basket_id)
+
+        ids = set()
+        for description in descriptions:
+            i = self.item_ids.get(description)
+            if i is None:
+                i = self.item_ids[description] = len(self.items)
+                self.items.append(description)
+            ids.add(i)
+
+        self.pending_ids.extend(sorted(ids))
+        self.pending_sizes.append(len(ids))
+        if len(self.pending_sizes) >= self.compact_every:
+            self.compact()
+
+        return True
+
+    def compact(self):
+        """Folds the buffered baskets into the support and pair counts.
+        """
+        if not self.pending_sizes:
+            return
+        ids = np.asarray(self.pending_ids, dtype=np.int64)
+        sizes = np.asarray(self.pending_sizes, dtype=np.int64)
+        self.n_baskets += len(sizes)
+        self.pending_ids = []
+        self.pending_sizes = []
+
+        support = np.bincount(ids, minlength=len(self.items))
+        support[:len(self.support)] += self.support
+        self.support = support
+
+        # each item pairs with the items after it in its basket (ids are sorted per basket)
+        ends = np.repeat(np.cumsum(sizes), sizes)
+        partners = ends - np.arange(len(ids)) - 1
+        left = np.repeat(np.arange(len(ids)), partners)
+        first = np.repeat(np.cumsum(partners) - partners, partners)
+        right = left + 1 + (np.arange(len(left)) - first)
+        keys = (ids[left] << 32) | ids[right]
+
+        # merge with the existing counts
+        keys = np.concatenate([self.pair_keys, keys])
+        counts = np.concatenate([self.pair_counts, np.ones(len(keys) - len(self.pair_keys),
+                                                           dtype=np.int64)])
+        self.pair_keys, inverse = np.unique(keys, return_inverse=True)
+        self.pair_counts = np.bincount(inverse.ravel(), weights=counts).astype(np.int64)
+
+    def to_model(self, **kwargs):
+        """Builds a cooccurrenceModel (top-K lists) from the current counts.
+        """
+        self.compact()
+        rows = (self.pair_keys >> 32).astype(np.int32)
+        cols = (self.pair_keys & 0xFFFFFFFF).astype(np.int32)
+        n_items = len(self.items)
+        C = sp.coo_matrix((np.concatenate([self.pair_counts, self.pair_counts]),
+                           (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+                          shape=(n_items, n_items))
+
+        return cooccurrenceModel.from_cooccurrence(C, self.support, self.n_baskets, self.items,
+                                                   **kwargs)
+
+    def snapshot(self, path=None):
+        """Writes the counts to a compact binary .npz file, atomically replacing any previous
+           snapshot so that readers never see a partial file.
+        """
+        path = path or self.snapshot_path
+        self.compact()
+        encoded = [item.encode('utf-8') for item in self.items]
+        item_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        item_offsets[1:] = np.cumsum([len(item) for item in encoded])
+
+        counted = '\n'.join(sorted(self.counted)).encode('utf-8')
+        offsets = ujson.dumps([[topic, partition, offset] 
+                               for (topic, partition), offset in sorted(self.offsets.items())])
+
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, version=self.SNAPSHOT_VERSION, n_baskets=self.n_baskets,
+                     item_bytes=np.frombuffer(b''.join(encoded), dtype=np.uint8),
+                     item_offsets=item_offsets, support=self.support,
+                     pair_keys=self.pair_keys, pair_counts=self.pair_counts,
+                     counted=np.frombuffer(counted, dtype=np.uint8),
+                     offsets=np.frombuffer(offsets.encode('utf-8'), dtype=np.uint8))
+        os.replace(tmp, path)
+        self.last_snapshot = time.time()
+
+    def maybe_snapshot(self):
+        """Writes a snapshot if the last one is older than snapshot_interval seconds.
+        """
+        if self.snapshot_path and time.time() - self.last_snapshot >= self.snapshot_interval:
+            self.snapshot()
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """Reads counts back from a snapshot, e.g. to resume counting or to build a model.
+        """
+        counts = cls(snapshot_path=path, **kwargs)
+        with np.load(path) as snapshot:
+            if int(snapshot['version']) != cls.SNAPSHOT_VERSION:
+                raise ValueError("Unsupported snapshot version " + str(snapshot['version']))
+            item_bytes = snapshot['item_bytes'].tobytes()
+            item_offsets = snapshot['item_offsets']
+            counts.items = [item_bytes[item_offsets[i]:item_offsets[i + 1]].decode('utf-8')
+                            for i in range(len(item_offsets) - 1)]
+            counts.item_ids = {item: i for i, item in enumerate(counts.items)}
+            counts.support = snapshot['support']
+            counts.pair_keys = snapshot['pair_keys']
+            counts.pair_counts = snapshot['pair_counts']
+            counts.n_baskets = int(snapshot['n_baskets'])
+            counted = snapshot['counted'].tobytes().decode('utf-8')
+            counts.counted = set(counted.split('\n')) if counted else set()
+            counts.offsets = {(topic, partition): offset for topic, partition, offset 
+                              in ujson.loads(snapshot['offsets'].tobytes().decode('utf-8'))}
+
+        return counts
+
+
+def compare_with_es(model, products, index='recommender_system'):
+    """Runs the significant_terms query for each product and reports how many of the
+       Elasticsearch recommendations the local model also recommends.
+    """
+    from QueryElasticsearch import (QUERY_WINDOW, correlated_buckets, execute_es_query, 
+                                    latest_timestamp, queryType)
+
+    # time windows end at the latest basket, which replayed data dates in the past
+    end = latest_timestamp(index) if QUERY_WINDOW is not None else None
+
+    overlaps = []
+    for product in products:
+        query = queryType(product, end=end).query_descriptions()
+        res = execute_es_query(index, query, product)
+        if res is None:
+            continue
+        es_items = [bucket['key'] for bucket in correlated_buckets(res)]
+        local_items = [item for item, count in model.recommend(product)]
+        if es_items:
+            overlap = len(set(es_items) & set(local_items)) / len(es_items)
+            overlaps.append(overlap)
+            print("{:40.40} overlap {:5.0%}".format(product, overlap))
+
+    if overlaps:
+        print("mean overlap with Elasticsearch: {:.1%} over {} products".format(
+            np.mean(overlaps), len(overlaps)))
+
+
+# Run
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the co-occurrence recommender and try it")
+    parser.add_argument("--source", choices=["data", "es", "snapshot"], default="data",
+                        help="build from the Online Retail data, an index scroll or the consumer's "
+                             "co-occurrence snapshot (default: data)")
+    parser.add_argument("--snapshot", default="cooccurrence.npz",
+                        help="co-occurrence snapshot written by KafkaConsumer.py (default: cooccurrence.npz)")
+    parser.add_argument("--top-k", type=int, default=10,
+                        help="recommendations kept per product (default: 10, as significant_terms)")
+    parser.add_argument("--min-doc-count", type=int, default=10,
+                        help="minimum number of shared baskets (default: 10, as query_descriptions)")
+    parser.add_argument("--scoring", choices=["jlh", "chi_square"], default="jlh",
+                        help="significance heuristic (default: jlh, the Elasticsearch default)")
+    parser.add_argument("--write-snapshot", default=None,
+                        help="publish the recommendations to a memory-mappable snapshot file")
+    parser.add_argument("--compare", type=int, default=0,
+                        help="compare the N most popular products with Elasticsearch")
+    args = parser.parse_args()
+
+    options = {"top_k": args.top_k, "min_doc_count": args.min_doc_count, "scoring": args.scoring}
+    start = time.time()
+    if args.source == "es":
+        model = cooccurrenceModel.from_baskets(scroll_baskets(), **options)
+    elif args.source == "snapshot":
+        model = cooccurrenceCounts.load(args.snapshot).to_model(**options)
+    else:
+        from RetailData import load_retail_data
+        model = cooccurrenceModel.from_dataframe(load_retail_data(), **options)
+    print("Built recommendations for {} products from {} baskets in {:.2f} s".format(
+        len(model.items), model.n_baskets, time.time() - start))
+
+    # lookup latency
+    popular = [model.items[i] for i in np.argsort(-model.support)]
+    start = time.perf_counter()
+    for product in popular:
+        model.recommend(product)
+    print("Mean lookup time: {:.1f} us".format((time.perf_counter() - start) / len(popular) * 1e6))
+
+    if args.write_snapshot:
+        from RecommendationSnapshot import write_snapshot
+        write_snapshot(model, args.write_snapshot)
+        print("Published " + args.write_snapshot)
+
+    if args.compare:
+        compare_with_es(model, popular[:args.compare])
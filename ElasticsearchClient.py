@@ -0,0 +1,330 @@
+# !/usr/bin/env python
+
+"""
+author   : Marcelo Sanches
+doc name : Elasticsearch client
+purpose  : to share one keep-alive, retrying Elasticsearch client between the producer-side
+           loaders, the Kafka consumer and the query tool
+date     : 05.06.2019
+version  : 3.7.2
+"""
+
+# Import modules
+import argparse
+import gzip
+import itertools
+import os
+import time
+import ujson
+import requests
+from urllib.parse import quote
+from requests.adapters import HTTPAdapter
+from Metrics import registry
+
+# hosts and timeout, overridable through the environment (comma-separated hosts)
+DEFAULT_HOSTS = os.environ.get('ES_HOSTS', 'http://elasticsearch:9200').split(',')
+DEFAULT_TIMEOUT = float(os.environ.get('ES_TIMEOUT', 30))
+
+# status codes meaning Elasticsearch is busy or a node is unavailable
+RETRY_STATUS = (429, 502, 503, 504)
+
+# mapping of basket documents: keywords for the aggregated fields, with global ordinals built
+# at refresh instead of on the first aggregation after it, and compact numeric types
+BASKET_MAPPING = {"dynamic": False,
+                  "properties": {"InvoiceNo": {"type": "keyword"},
+                                 "CustomerID": {"type": "integer"},
+                                 "Country": {"type": "keyword"},
+                                 "StockCodes": {"type": "keyword", "eager_global_ordinals": True},
+                                 "Descriptions": {"type": "keyword", "eager_global_ordinals": True},
+                                 "Quantities": {"type": "integer"},
+                                 "UnitPrices": {"type": "scaled_float", "scaling_factor": 1000},
+                                 "timestamp": {"type": "date", "format": "epoch_millis"},
+                                 "indexed_at": {"type": "date"}}}
+
+# ingest pipeline of the basket indices, stamping each basket with the time it was indexed:
+# baskets arrive out of invoice order, so their own timestamps cannot tell what is new
+INGEST_PIPELINE = 'basket-indexed-at'
+
+# client shared by the whole process, see get_client
+shared_client = None
+
+# request metrics, labeled by API (e.g. _bulk, _search)
+es_latency = registry.histogram('es_request_seconds', 'Elasticsearch request latency')
+es_errors = registry.counter('es_errors_total', 'Elasticsearch requests that failed or were retried')
+
+
+# Setup classes
+class esClient():
+    """This class keeps a pool of keep-alive connections to a list of Elasticsearch hosts,
+       spreading requests over them round-robin, gzip-compressing request bodies and
+       retrying with exponential backoff when a host is down or busy.
+    """
+
+    def __init__(self, hosts=None, timeout=DEFAULT_TIMEOUT, retries=3, backoff=0.1,
+                 max_backoff=10, compress=True, pool_size=10):
+        self.hosts = [host.rstrip('/') for host in (hosts or DEFAULT_HOSTS)]
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.compress = compress
+        self.next_host = itertools.cycle(self.hosts)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.hosts), pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, path, body=None, params=None, ndjson=False):
+        """Sends a request to the next host, retrying on connection errors and busy
+           responses. The body may be a dictionary (sent as JSON) or an already encoded
+           string/bytes (e.g. a _bulk body). Returns the last response, or raises the last
+           connection error if no host answered.
+        """
+        headers = {}
+        data = None
+        if body is not None:
+            if isinstance(body, dict):
+                body = ujson.dumps(body)
+            data = body.encode('utf-8') if isinstance(body, str) else body
+            headers['Content-Type'] = 'application/x-ndjson' if ndjson else 'application/json'
+            if self.compress:
+                data = gzip.compress(data, compresslevel=1)
+                headers['Content-Encoding'] = 'gzip'
+
+        endpoint = endpoint_name(path)
+        for attempt in range(self.retries + 1):
+            url = next(self.next_host) + path
+            start = time.perf_counter()
+            try:
+                r = self.session.request(method, url, data=data, params=params,
+                                         headers=headers, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                es_errors.inc(endpoint=endpoint, reason='connection')
+                if attempt == self.retries:
+                    raise
+            else:
+                es_latency.observe(time.perf_counter() - start, endpoint=endpoint)
+                # checking whether an index exists (HEAD) or getting a missing document by id 
+                # is not an error
+                missing = method == 'GET' and r.status_code == 404 and '/_doc/' in path
+                if r.status_code >= 400 and method != 'HEAD' and not missing:
+                    es_errors.inc(endpoint=endpoint, reason=str(r.status_code))
+                if r.status_code not in RETRY_STATUS or attempt == self.retries:
+                    return r
+            time.sleep(min(self.backoff * 2**attempt, self.max_backoff))
+
+    def get(self, path, body=None, params=None):
+        return self.request('GET', path, body, params)
+
+    def head(self, path):
+        return self.request('HEAD', path)
+
+    def put(self, path, body=None, params=None):
+        return self.request('PUT', path, body, params)
+
+    def post(self, path, body=None, params=None):
+        return self.request('POST', path, body, params)
+
+    def delete(self, path):
+        return self.request('DELETE', path)
+
+    def search(self, index, query):
+        """Runs a search on an index, returning the parsed response or None on error.
+        """
+        r = self.get('/{}/_search'.format(index), query)
+        if r.status_code != 200:
+            return None
+
+        return r.json()
+
+    def bulk(self, path, body):
+        """Sends a newline-delimited body to a _bulk endpoint.
+        """
+        return self.request('POST', path, body, ndjson=True)
+
+    def msearch(self, index, queries):
+        """Runs several searches on an index in one _msearch request, returning the parsed
+           response (one entry per query in 'responses') or None on error.
+        """
+        lines = []
+        for query in queries:
+            lines.append('{}')
+            lines.append(ujson.dumps(query))
+        r = self.request('POST', '/{}/_msearch'.format(index), '\n'.join(lines) + '\n',
+                         ndjson=True)
+        if r.status_code != 200:
+            return None
+
+        return r.json()
+
+
+# Setup functions
+def endpoint_name(path):
+    """Names the API a request path calls (e.g. _bulk, _search), or 'document' for paths to
+       an index or a document.
+    """
+    for segment in reversed(path.split('/')):
+        if segment.startswith('_'):
+            return segment
+
+    return 'document'
+
+def get_client():
+    """Returns the client shared by the whole process, creating it on first use.
+    """
+    global shared_client
+    if shared_client is None:
+        shared_client = esClient()
+
+    return shared_client
+
+def basket_id(basket):
+    """Returns the document id of a basket: its invoice number, so that indexing a basket 
+       again replaces it instead of adding a duplicate.
+    """
+    return str(basket['InvoiceNo'])
+
+def doc_path(index, doc_id):
+    """Returns the path of a document, escaping its id.
+    """
+    return "/{}/_doc/{}".format(index, quote(doc_id, safe=''))
+
+def bulk_body(docs, ids=None):
+    """Builds a newline-delimited _bulk request body indexing each document, under the 
+       given ids if any (an existing document with the same id is replaced). Documents may 
+       be dictionaries or already encoded JSON bytes, which are copied in as they are.
+    """
+    lines = []
+    for i, doc in enumerate(docs):
+        if ids is None:
+            lines.append(b'{"index":{}}')
+        else:
+            lines.append(ujson.dumps({"index": {"_id": ids[i]}}).encode('utf-8'))
+        lines.append(doc if isinstance(doc, bytes) else ujson.dumps(doc).encode('utf-8'))
+
+    return b'\n'.join(lines) + b'\n'
+
+def bulk_errors(docs, res):
+    """Pairs each document with the result of its _bulk action when that action failed.
+    """
+    if not res.get('errors'):
+        return []
+
+    failed = []
+    for doc, item in zip(docs, res['items']):
+        result = list(item.values())[0]
+        if result['status'] not in (200, 201):
+            failed.append((doc, result))
+
+    return failed
+
+def transient_error(status):
+    """Returns whether a request or _bulk action that failed with this status may succeed if
+       sent again, because Elasticsearch was busy (429) or failing (5xx).
+    """
+    return status == 429 or status >= 500
+
+def create_index(index, index_config, es=None):
+    """Creates an index in Elasticsearch
+    """
+    r = (es or get_client()).put('/{}'.format(index), index_config)
+
+    if r.status_code != 200:
+        print("Error creating index")
+    else:
+        print("Index created")
+
+def alias_indices(alias, es=None):
+    """Returns the names of the indices behind an alias, or an empty list if there is no 
+       such alias.
+    """
+    r = (es or get_client()).get('/_alias/{}'.format(alias))
+    if r.status_code != 200:
+        return []
+
+    return sorted(r.json().keys())
+
+def delete_index(index, es=None):
+    """Deletes an index in Elasticsearch, or every index behind it if it is an alias
+    """
+    target = ','.join(alias_indices(index, es)) or index
+    r = (es or get_client()).delete('/{}'.format(target))
+    if r.status_code != 200:
+        print("Error deleting index")
+    else:
+        print("Index deleted")
+
+def put_ingest_pipeline(es=None):
+    """Installs (or updates) the ingest pipeline setting indexed_at on every basket.
+    """
+    pipeline = {"description": "records when a basket was indexed",
+                "processors": [{"set": {"field": "indexed_at", "value": "{{{_ingest.timestamp}}}"}}]}
+    r = (es or get_client()).put('/_ingest/pipeline/{}'.format(INGEST_PIPELINE), pipeline)
+    if r.status_code != 200:
+        print("Error installing ingest pipeline: " + r.text)
+
+def put_basket_template(alias, es=None):
+    """Installs (or updates) the index template applied to every basket index behind an 
+       alias, i.e. to the indices named alias-000001 (or alias-000002, ... when reindexing 
+       into a new mapping), and the ingest pipeline it runs by default.
+    """
+    put_ingest_pipeline(es)
+    template = {"index_patterns": [alias + "-*"],
+                "priority": 100,
+                "template": {"settings": {"number_of_shards": 1,
+                                          "default_pipeline": INGEST_PIPELINE},
+                             "mappings": BASKET_MAPPING}}
+    r = (es or get_client()).put('/_index_template/{}'.format(alias), template)
+    if r.status_code != 200:
+        print("Error installing index template: " + r.text)
+
+def put_ingest_settings(index, es=None):
+    """Makes existing basket indices (created before the ingest pipeline) run it from now on.
+    """
+    es = es or get_client()
+    r = es.put('/{}/_mapping'.format(index), {"properties": {"indexed_at": {"type": "date"}}})
+    if r.status_code == 200:
+        r = es.put('/{}/_settings'.format(index), {"index": {"default_pipeline": INGEST_PIPELINE}})
+    if r.status_code != 200:
+        print("Error updating " + index + " for the ingest pipeline: " + r.text)
+
+def check_index(index_name, es=None):
+    """Checks whether the basket alias exists in Elasticsearch; if not, installs the index
+        template and creates the index behind the alias. The alias is not rolled over: 
+        baskets are indexed under their invoice numbers, which only makes a replayed basket
+        replace itself within one index.
+    """
+    es = es or get_client()
+    put_basket_template(index_name, es)
+    if alias_indices(index_name, es):
+        print('index exists')
+        put_ingest_settings(index_name, es)
+    elif es.head('/{}'.format(index_name)).status_code == 200:
+        print('index exists but is not an alias, it keeps its old mapping until reindexed')
+        put_ingest_settings(index_name, es)
+    else:
+        index_config = {"aliases": {index_name: {"is_write_index": True}}}
+
+        create_index(index_name + '-000001', index_config, es)
+
+def print_es_indices(es=None):
+    """Prints to console current Elasticsearch indices.
+    """
+    r = (es or get_client()).get('/_cat/indices', params={'v': 'true'})
+    if r.status_code != 200:
+        print("Error listing indices")
+    else:
+        print(r.text)
+
+
+# Run
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the basket indices")
+    parser.add_argument("--alias", default="recommender_system",
+                        help="alias searched and written by the scripts (default: recommender_system)")
+    args = parser.parse_args()
+
+    # installs or updates the template and creates the alias if needed
+    check_index(args.alias)
+    print_es_indices()
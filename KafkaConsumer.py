@@ -9,6 +9,7 @@ version  : 3.7.2
 """
 
 # Import modules 
+import argparse
 import json
 import os 
 import time
@@ -16,117 +17,355 @@ import pandas as pd
 import requests
 from concurrent.futures import wait
 import ujson
-from confluent_kafka import Consumer, KafkaError
-from elasticsearch import Elasticsearch
+from confluent_kafka import Consumer, KafkaError, KafkaException, TopicPartition
+from BasketBuilder import get_timestamp
+from ElasticsearchClient import (get_client, basket_id, bulk_body, bulk_errors, check_index, 
+                                 delete_index, doc_path, print_es_indices, transient_error)
+from Metrics import registry, start_reporting
+from MessageCodec import bulk_source, decode_msg
 
-# Elasticsearch setup functions
-def create_index(index, index_config):
-    """Creates an index in Elasticsearch
-    """
-    r = requests.put("http://elasticsearch:9200/{}".format(index), json=index_config)
-	
-    if r.status_code != 200:
-        print("Error creating index")
-    else:
-        print("Index created")
+# Kafka consumer setup
+recommender_system_topic = 'recommender.system.1'
 
-def delete_index(index):
-    """Deletes an index in Elasticsearch
-    """
-    r = requests.delete("http://elasticsearch:9200/{}".format(index))
-    if r.status_code != 200:
-        print("Error deleting index")
-    else:
-        print("Index deleted")
+consumer_config = {'bootstrap.servers': 'kafka-1:9092',
+                   'group.id': 'recommender.system.consumer.2',
+                   'api.version.request': True,
+                   'log.connection.close': False,
+                   'socket.keepalive.enable': True,
+                   'session.timeout.ms': 6000,
+                   'default.topic.config': {'auto.offset.reset': 'smallest'}}
 
-def check_index(index_name):
-    """Checks whether an index exists in Elasticsearch; if not, creates it with the index 
-        configurations specified below.
-    """
-    es_conn = Elasticsearch("http://elasticsearch:9200")
-    res = es_conn.indices.exists(index=index_name)
-    if res == True:
-        print('index exists')
-    else:
-        index_config = {"mappings":
-                            {"basket":
-                                {"properties":
-                                    {"timestamp": {"type": "date"},
-                                     "StockCodes": {"type": "string"},
-                                     "Descriptions": {"type": "string", 
-                                                      "index": "not_analyzed"}
-                                    }
-                                }
-                            }
-                        }
-
-        create_index(index_name, index_config)
-
-def print_es_indices():
-    """Prints to console current Elasticsearch indices.
-    """
-    r = requests.get("http://elasticsearch:9200/_cat/indices?v")
-    if r.status_code != 200:
-        print("Error listing indices")
-    else:
-        print(r.text)
+# consumer metrics
+baskets_consumed = registry.counter('baskets_consumed_total', 'Baskets consumed from Kafka')
+index_errors = registry.counter('index_errors_total', 'Baskets Elasticsearch failed to index')
+etl_time = registry.histogram('etl_seconds', 'Time to transform and index a basket or a batch')
+consumer_lag = registry.gauge('consumer_lag', 'Messages behind the end of each partition')
+
+# seconds between consumer lag checks in one-message-at-a-time mode
+LAG_CHECK_INTERVAL = 5
+
+# seconds a batch is retried for while Elasticsearch is unavailable, well below the default 
+# max.poll.interval.ms (300 s) after which Kafka hands the partitions to another consumer
+BULK_RETRY_TIME = 120
 
-def get_timestamp(date_element):
-    """Transform InvoiceDate into an Elasticsearch-friendly timestamp in milliseconds.
+
+# Setup functions
+def transform_msg(msg):
+    """Reshapes a basket into ES-friendly format, replacing InvoiceDate with a timestamp 
+       unless the producer already shipped one.
     """
-    date = date_element.split()[0]
-    time = date_element.split()[1]
-
-    year = int(date.split('-')[0])
-    month = int(date.split('-')[1])
-    day =  int(date.split('-')[2])
-
-    hours = int(time.split(':')[0])
-    mins = int(time.split(':')[1])
-    secs = int(time.split(':')[2])
-    	
-    return int(pd.Timestamp(year,month,day,hours,mins,secs).timestamp()*1000)
+    if "timestamp" not in msg:
+        msg["timestamp"] = get_timestamp(msg["InvoiceDate"])
+    msg.pop("InvoiceDate", None)
+
 	
-def ETL_msg(msg):
-    """ Extract-Transform-Load messages into Elasticsearch
+def ETL_msg(msg, doc_id=None):
+    """ Extract-Transform-Load messages into Elasticsearch, under the basket's invoice number 
+    (or doc_id) so that a replayed basket replaces itself. Returns True once the basket was 
+    indexed or permanently rejected (4xx, reported and skipped, as in bulk mode), and False 
+    if Elasticsearch could not be reached or was busy or failing (429 or 5xx), so that the 
+    basket is sent again.
     """
-    # reshape into ES-friendly format
-    msg["timestamp"] = get_timestamp(msg["InvoiceDate"])
-    del msg["InvoiceDate"]
+    start = time.perf_counter()
+
+    # reshape into ES-friendly format, unless the message bytes already are
+    if isinstance(msg, dict):
+        transform_msg(msg)
 
     # fling into ES
-    r = requests.post("http://elasticsearch:9200/recommender_system/basket", json=msg)
+    doc_id = doc_id or basket_id(msg)
+    try:
+        r = get_client().put(doc_path("recommender_system", doc_id), msg)
+    except requests.exceptions.RequestException as e:
+        print("Error sending message: " + str(e))
+        return False
+    if transient_error(r.status_code):
+        print("Error sending message: status code " + str(r.status_code))
+        return False
 	
-    # if there is an error, display the code 
-    if r.status_code != 201:
+    # if there is an error, display the code; consumed baskets are only counted, once 
+    # Elasticsearch has answered for them, since printing each of them throttles the consumer
+    baskets_consumed.inc()
+    if r.status_code not in (200, 201):
+        index_errors.inc()
         print(" "*100)
         print("*"*80)
-        print("Error sending message: status code " +str(r.status_code))
-	
-    # else print the basket being consumed (uncomment pass and comment print for quicker consumer)
-    else:
-        #pass
-        print("consumed basket " +msg['InvoiceNo'])
-		
+        print("Error indexing basket " + doc_id + ": status code " + str(r.status_code) 
+              + " " + r.text)
+    etl_time.observe(time.perf_counter() - start, mode='single')
+
+    return True
 
+def load_bulk(msgs, ids=None, retries=5, backoff=0.1):
+    """Loads a batch of already transformed messages into Elasticsearch through the _bulk 
+       API, indexing each under its id (the invoice number unless given) so that replays 
+       replace documents instead of duplicating them. Baskets rejected one by one because 
+       Elasticsearch was busy (429) or failing (5xx) are sent again on their own with 
+       exponential backoff. Returns True once every basket was indexed or permanently 
+       rejected (4xx, reported and skipped), and False if the batch could not be sent or 
+       baskets were still being rejected, so that its offsets are not committed.
+    """
+    if ids is None:
+        ids = [basket_id(msg) for msg in msgs]
+
+    # each basket travels with its id, so that rejected ones can be sent again on their own
+    pending = list(zip(msgs, ids))
+    for attempt in range(retries + 1):
+        # the client retries with backoff on connection errors or a busy cluster
+        try:
+            r = get_client().bulk("/recommender_system/_bulk", 
+                                  bulk_body([msg for msg, _ in pending], [i for _, i in pending]))
+        except requests.exceptions.RequestException as e:
+            print("Error sending batch: " + str(e))
+            return False
+        if r.status_code != 200:
+            print("Error sending batch: status code " + str(r.status_code))
+            return False
+
+        # report permanent per-document errors instead of failing the whole batch, keeping 
+        # transient ones for another attempt
+        rejected = []
+        for (msg, doc_id), result in bulk_errors(pending, r.json()):
+            if transient_error(result["status"]):
+                rejected.append((msg, doc_id))
+                continue
+            index_errors.inc()
+            if isinstance(msg, bytes):
+                msg = ujson.loads(msg)
+            print("Error indexing basket " + str(msg["InvoiceNo"]) + ": status code " 
+                  + str(result["status"]) + " " + str(result.get("error")))
+        if not rejected:
+            return True
+
+        pending = rejected
+        if attempt < retries:
+            time.sleep(backoff * 2 ** attempt)
+
+    print("Error sending batch: " + str(len(pending)) + " baskets still rejected")
+    return False
+
+def retry(function, args, what, max_time=BULK_RETRY_TIME):
+    """Calls function(*args) until it returns True, retrying with exponential backoff for up 
+       to max_time seconds while Elasticsearch cannot be reached or refuses the request, so 
+       that a short outage does not stop the consumer. Returns whether it succeeded.
+    """
+    delay = 1
+    deadline = time.time() + max_time
+    while not function(*args):
+        if time.time() + delay > deadline:
+            return False
+        print("Retrying " + what + " in " + str(delay) + " s")
+        time.sleep(delay)
+        delay = min(delay * 2, 30)
+
+    return True
+
+def load_bulk_retry(msgs, ids=None, max_time=BULK_RETRY_TIME):
+    """Loads a batch with load_bulk, retrying it while Elasticsearch is unavailable. Returns 
+       whether the batch was accepted.
+    """
+    return retry(load_bulk, (msgs, ids), "batch", max_time)
+
+def ETL_bulk(msgs, ids=None):
+    """Extract-Transform-Load a batch of messages into Elasticsearch through the _bulk API,
+       retrying the batch while Elasticsearch is unavailable.
+    """
+    with etl_time.time(mode='bulk'):
+        for msg in msgs:
+            if isinstance(msg, dict):
+                transform_msg(msg)
+        baskets_consumed.inc(len(msgs))
+
+        return load_bulk_retry(msgs, ids)
+
+def record_lag(consumer, offsets):
+    """Records, for each partition, how many messages are left between the next offset to 
+       consume and the end of the partition.
+    """
+    for (topic, partition), offset in offsets.items():
+        try:
+            low, high = consumer.get_watermark_offsets(TopicPartition(topic, partition), 
+                                                       timeout=1)
+        except KafkaException:
+            continue
+        consumer_lag.set(max(0, high - offset), topic=topic, partition=partition)
+
+
+class basketBatcher():
+    """This class accumulates consumed messages and flings them into Elasticsearch in bulk 
+       once a size or time threshold is hit, committing Kafka offsets only after 
+       Elasticsearch confirms the batch.
+    """
+
+    def __init__(self, consumer, batch_size=500, linger_ms=1000, report=True, model=None):
+        self.consumer = consumer
+        self.report = report
+        self.model = model
+        self.batch_size = batch_size
+        self.linger = linger_ms / 1000.0
+        self.msgs = []
+        self.ids = []
+        self.offsets = {}
+        self.first_msg_time = None
+        self.start_time = time.time()
+        self.docs_indexed = 0
+
+    def add(self, msg):
+        """Adds the basket of a Kafka message to the batch and records its offset. Baskets 
+           are only decoded if they cannot be indexed as they are or the model needs them.
+        """
+        if not self.msgs:
+            self.first_msg_time = time.time()
+        doc = read_msg(msg, self.model)
+        self.msgs.append(doc)
+        self.ids.append(msg_id(msg, doc))
+        self.offsets[(msg.topic(), msg.partition())] = msg.offset() + 1
+
+    def timeout(self):
+        """Returns how long the consumer may wait for messages before the batch is due.
+        """
+        if not self.msgs:
+            return self.linger
+        return max(0, self.first_msg_time + self.linger - time.time())
+
+    def is_due(self):
+        """Checks whether the batch is full or has been waiting longer than the linger time.
+        """
+        return len(self.msgs) >= self.batch_size or (bool(self.msgs) and self.timeout() == 0)
+
+    def flush(self):
+        """Flings the current batch into Elasticsearch and commits the offsets it covers.
+        """
+        if not self.msgs:
+            return
+
+        n = len(self.msgs)
+        if not ETL_bulk(self.msgs, self.ids):
+            raise Exception("Elasticsearch did not accept the batch after retrying for "
+                            + str(BULK_RETRY_TIME) + " s, offsets not committed")
+
+        self.consumer.commit(offsets=[TopicPartition(topic, partition, offset) 
+                                      for (topic, partition), offset in self.offsets.items()],
+                             asynchronous=False)
+        record_lag(self.consumer, self.offsets)
+        update_model(self.model, self.msgs, self.ids, self.offsets)
+        self.msgs = []
+        self.ids = []
+        self.offsets = {}
+
+        # throughput report
+        self.docs_indexed += n
+        if not self.report:
+            return
+        elapsed = time.time() - self.start_time
+        print("consumed batch of " + str(n) + " baskets, " 
+              + str(round(self.docs_indexed / elapsed, 1)) + " docs/sec")
+
+
+def read_msg(msg, model=None):
+    """Returns the message bytes when they can be indexed as they are, otherwise the decoded 
+       basket. Baskets are always decoded when a co-occurrence model counts their products.
+    """
+    doc = bulk_source(msg) if model is None else None
+
+    return doc if doc is not None else decode_msg(msg)
+
+def msg_id(msg, doc):
+    """Returns the document id of a consumed basket: its invoice number, read from the 
+       message key when the basket was not decoded.
+    """
+    if isinstance(doc, dict):
+        return basket_id(doc)
+
+    return msg.key().decode('utf-8')
+
+def update_model(model, msgs, ids=None, offsets=None):
+    """Counts indexed baskets into the co-occurrence model, if there is one, once per 
+       document id, records the Kafka offsets up to which every basket has been counted 
+       and snapshots the model to disk when it is due.
+    """
+    if model is None:
+        return
+    for i, msg in enumerate(msgs):
+        model.update(msg["Descriptions"], None if ids is None else ids[i])
+    if offsets:
+        model.offsets.update(offsets)
+    model.maybe_snapshot()
+
+def resume_model(model):
+    """Returns an on_assign callback starting assigned partitions from the offsets of the 
+       model's snapshot, so that baskets committed after the snapshot was written are 
+       counted again after a restart (Elasticsearch replaces them, the model skips those it 
+       already counted).
+    """
+    def on_assign(consumer, partitions):
+        for p in partitions:
+            if (p.topic, p.partition) in model.offsets:
+                p.offset = model.offsets[(p.topic, p.partition)]
+        consumer.assign(partitions)
+
+    return on_assign
+
+def consume_bulk(c, batch_size, linger_ms, model=None):
+    """Consumes the stream in batches and flings them into Elasticsearch in bulk.
+    """
+    batcher = basketBatcher(c, batch_size, linger_ms, model=model)
+
+    while True:
+
+        # consume up to a full batch, waiting at most until the batch is due
+        msgs = c.consume(num_messages=batch_size - len(batcher.msgs), 
+                         timeout=batcher.timeout())
+
+        for msg in msgs:
+            if msg.error():
+                if msg.error().code() == KafkaError._PARTITION_EOF:
+                    continue
+                else:
+                    raise KafkaException(msg.error())
+            batcher.add(msg)
+
+        if batcher.is_due():
+            batcher.flush()
+
+		
 # Run 
 if __name__ == "__main__":
+    # command line options
+    parser = argparse.ArgumentParser(description="Consume baskets from Kafka and fling them into Elasticsearch")
+    parser.add_argument("--bulk", action="store_true",
+                        help="index baskets in batches through the Elasticsearch _bulk API")
+    parser.add_argument("--async", dest="async_mode", action="store_true",
+                        help="run the asyncio pipeline with several bulk requests in flight")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="maximum number of bulk requests in flight in async mode (default: 4)")
+    parser.add_argument("--batch-size", type=int, default=500,
+                        help="maximum number of baskets per bulk request (default: 500)")
+    parser.add_argument("--linger-ms", type=int, default=1000,
+                        help="maximum time a basket waits for its batch to fill up (default: 1000)")
+    parser.add_argument("--cooccurrence-snapshot", default=None,
+                        help="keep item co-occurrence counts up to date and snapshot them to this file")
+    parser.add_argument("--snapshot-interval", type=float, default=60,
+                        help="seconds between co-occurrence snapshots (default: 60)")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics at http://0.0.0.0:PORT/metrics")
+    parser.add_argument("--metrics-interval", type=float, default=10,
+                        help="seconds between metrics log lines, 0 to disable (default: 10)")
+    args = parser.parse_args()
+    start_reporting(args.metrics_port, args.metrics_interval)
+
     # Kafka consumer setup 
-    recommender_system_topic = 'recommender.system.1'
-
-    c = Consumer({'bootstrap.servers': 'kafka-1:9092',
-        	      'group.id': 'recommender.system.consumer.2',
-		      'api.version.request': True,
-		      'log.connection.close': False,
-		      'socket.keepalive.enable': True,
-		      'session.timeout.ms': 6000,
-		      'default.topic.config': {'auto.offset.reset': 'smallest'}})
-        
-    # subscribe to Kafka producer topic
-    c.subscribe(['recommender.system.1'])
+    consumer_config = dict(consumer_config)
+
+    # offsets are committed only once Elasticsearch has confirmed a basket or a batch; 
+    # baskets are indexed under their invoice numbers, so those replayed after a restart 
+    # or a rebalance replace themselves instead of being duplicated
+    consumer_config['enable.auto.commit'] = False
+
+    c = Consumer(consumer_config)
         
     # Elasticsearch setup
-    r = requests.get("http://elasticsearch:9200")
+    r = get_client().get("/")
     if r.status_code != 200:
         print("Error talking to Elasticsearch")
             
@@ -138,8 +377,35 @@ if __name__ == "__main__":
     check_index(index_name)
     print_es_indices()
 
+    # item co-occurrence counts, resumed from the last snapshot if there is one
+    model = None
+    if args.cooccurrence_snapshot:
+        from CooccurrenceRecommender import cooccurrenceCounts
+        if os.path.isfile(args.cooccurrence_snapshot):
+            model = cooccurrenceCounts.load(args.cooccurrence_snapshot, 
+                                            snapshot_interval=args.snapshot_interval)
+        else:
+            model = cooccurrenceCounts(snapshot_path=args.cooccurrence_snapshot, 
+                                       snapshot_interval=args.snapshot_interval)
+
+    # subscribe to Kafka producer topic, resuming from the model's snapshot if there is one
+    if model is not None:
+        c.subscribe([recommender_system_topic], on_assign=resume_model(model))
+    else:
+        c.subscribe([recommender_system_topic])
+
+    # consume stream with concurrent bulk requests
+    if args.async_mode:
+        from AsyncConsumerPipeline import consume_async
+        consume_async(c, args.batch_size, args.linger_ms, args.concurrency, model)
+
+    # consume stream in batches
+    if args.bulk:
+        consume_bulk(c, args.batch_size, args.linger_ms, model)
 
-    # consume stream 
+    # consume stream, checking the lag of the partitions seen every few seconds
+    offsets = {}
+    last_lag_check = time.time()
     while True:
             
         # consume one message at a time 
@@ -156,11 +422,21 @@ if __name__ == "__main__":
             
         # if no error (message received)
         else:
-            # decode bytes into strings, deserialize strings into dictionary structure
-            data = ujson.loads(msg.value().decode('utf-8'))
+            # keep the message bytes if they are ready to index, otherwise decode the basket
+            data = read_msg(msg, model)
                 
-            # fling each basket into Elasticsearch
-            ETL_msg(data)
+            # fling each basket into Elasticsearch, then commit its offset; a basket rejected 
+            # for good is reported and skipped as in bulk mode, while one Elasticsearch keeps 
+            # refusing (unreachable, busy or failing) stops the consumer before its offset
+            doc_id = msg_id(msg, data)
+            if not retry(ETL_msg, (data, doc_id), "basket " + doc_id):
+                raise Exception("Elasticsearch did not index basket " + doc_id + " after retrying for "
+                                + str(BULK_RETRY_TIME) + " s, offset not committed")
+            c.commit(message=msg, asynchronous=True)
+            update_model(model, [data], [doc_id], 
+                         {(msg.topic(), msg.partition()): msg.offset() + 1})
 
-		
-		
+            offsets[(msg.topic(), msg.partition())] = msg.offset() + 1
+            if time.time() - last_lag_check >= LAG_CHECK_INTERVAL:
+                record_lag(c, offsets)
+                last_lag_check = time.time()
@@ -9,9 +9,9 @@ version  : 3.7.2
 """
 
 # Import modules 
+import argparse
 import os
 import time
-import ujson
 import pandas as pd
 import requests
 #import urllib2
@@ -19,6 +19,18 @@ from retrying import retry
 from confluent_kafka.admin import AdminClient, NewTopic
 from confluent_kafka import Producer
 from concurrent.futures import wait
+from BasketBuilder import stream_baskets
+from RetailData import CHUNK_ROWS, iter_retail_chunks
+from Metrics import registry, start_reporting
+from MessageCodec import CODECS, DEFAULT_CODEC, get_codec
+
+# producer metrics
+baskets_produced = registry.counter('baskets_produced_total', 'Baskets handed to the producer')
+baskets_delivered = registry.counter('baskets_delivered_total', 'Baskets acknowledged by Kafka')
+delivery_errors = registry.counter('delivery_errors_total', 'Baskets Kafka failed to deliver')
+delivery_latency = registry.histogram('delivery_latency_seconds',
+                                      'Time from producing a basket to its delivery report')
+queue_full = registry.counter('producer_queue_full_total', 'Times the local producer queue was full')
 
 
 # Setup functions
@@ -59,10 +71,111 @@ def create_recommender_system_topic():
 
     print(topics)
 
-	
+def delivery_report(err, msg):
+    """Reports baskets that could not be delivered to the Kafka topic.
+    """
+    if err is not None:
+        delivery_errors.inc()
+        print("Error delivering basket " + str(msg.key()) + ": " + str(err))
+        return
+
+    baskets_delivered.inc()
+    latency = msg.latency()
+    if latency is not None:
+        delivery_latency.observe(latency)
+
+def produce_basket(producer, topic, basket, codec=None):
+    """Produces one basket to the Kafka topic, keyed by its invoice number so that an invoice 
+       always lands on the same partition, and encoded with a message codec (the default 
+       codec unless given). When the local queue is full, serves delivery reports until 
+       there is room again instead of waiting a fixed time.
+    """
+    msgbytes, headers = (codec or get_codec(DEFAULT_CODEC)).encode(basket)
+    key = str(basket['InvoiceNo']).encode('utf-8')
+
+    while True:
+        try:
+            producer.produce(topic, msgbytes, key=key, headers=headers, 
+                             on_delivery=delivery_report)
+            break
+        except BufferError:
+            queue_full.inc()
+            producer.poll(1)
+    baskets_produced.inc()
+
+    # serve delivery reports of earlier messages
+    producer.poll(0)
+
+
+
+# Setup classes
+class replayPacer():
+    """This class paces the replay of baskets, either at a fixed rate (baskets per second)
+       or following the baskets' original timestamps sped up by a factor. While waiting,
+       the producer keeps serving delivery reports. Without a rate or speedup, baskets are
+       produced as fast as Kafka takes them.
+    """
+
+    def __init__(self, rate=None, speedup=None):
+        self.rate = rate
+        self.speedup = speedup
+        self.start = None
+        self.first_timestamp = None
+        self.n = 0
+
+    def due(self, basket):
+        """Returns the wall-clock time at which a basket is due.
+        """
+        if self.start is None:
+            self.start = time.time()
+            self.first_timestamp = basket.get('timestamp')
+        self.n += 1
+
+        if self.rate:
+            return self.start + (self.n - 1) / float(self.rate)
+        if self.speedup and self.first_timestamp is not None:
+            return self.start + (basket['timestamp'] - self.first_timestamp) / 1000.0 / self.speedup
+
+        return self.start
+
+    def wait(self, producer, basket):
+        """Serves delivery reports until the basket is due.
+        """
+        due = self.due(basket)
+        delay = due - time.time()
+        while delay > 0:
+            producer.poll(delay)
+            delay = due - time.time()
+
 
 # Run
 if __name__ == '__main__':
+
+    # command line options
+    parser = argparse.ArgumentParser(description="Produce one message per basket to a Kafka topic")
+    parser.add_argument("--linger-ms", type=int, default=50,
+                        help="time librdkafka waits to fill up a message batch (default: 50)")
+    parser.add_argument("--batch-num-messages", type=int, default=10000,
+                        help="maximum number of messages per batch (default: 10000)")
+    parser.add_argument("--compression", default="lz4",
+                        choices=["none", "gzip", "snappy", "lz4", "zstd"],
+                        help="compression codec for message batches (default: lz4)")
+    parser.add_argument("--codec", default=DEFAULT_CODEC, choices=sorted(CODECS),
+                        help="basket encoding (default: " + DEFAULT_CODEC + ")")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="replay at most this many baskets per second")
+    parser.add_argument("--speedup", type=float, default=None,
+                        help="replay following the original invoice times, this many times faster")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS,
+                        help="rows read at a time from the data file (default: " + str(CHUNK_ROWS) + ")")
+    parser.add_argument("--loop", action="store_true",
+                        help="replay the data again each time it ends")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics at http://0.0.0.0:PORT/metrics")
+    parser.add_argument("--metrics-interval", type=float, default=10,
+                        help="seconds between metrics log lines, 0 to disable (default: 10)")
+    args = parser.parse_args()
+    start_reporting(args.metrics_port, args.metrics_interval)
     
     # Basic setup 
     recommender_system_topic = 'recommender.system.1'
@@ -74,7 +187,11 @@ if __name__ == '__main__':
     create_recommender_system_topic()
 
     # setup producer 
-    p = Producer({'bootstrap.servers': 'kafka-1:9092'})
+    codec = get_codec(args.codec)
+    p = Producer({'bootstrap.servers': 'kafka-1:9092',
+                  'linger.ms': args.linger_ms,
+                  'batch.num.messages': args.batch_num_messages,
+                  'compression.type': args.compression})
     
     while True:
 	
@@ -85,61 +202,22 @@ if __name__ == '__main__':
         #response=urllib2.urlopen(file_path)
         #html=response.read()
         
-        # reading from local file instead
-        # convert Excel file to CSV if first time 
-        if os.path.isfile('./Online Retail.csv') == True:
-            pass
-        else:
-            df = pd.read_excel("Online Retail.xlsx")
-            # filter out missing data (~25% CustomerIDs are NA)
-            df = df.dropna()
-            # change CustomerID to integer
-            df['CustomerID'] = df['CustomerID'].astype(int)
-            # save as CSV 
-            df.to_csv("Online_Retail.csv", index=False)
-
-        # read in CSV
-        df = pd.read_csv('Online_Retail.csv')
-
-        # group by invoice num
-        invoice_groups = df.groupby('InvoiceNo')
-
-        # iterate over each group (each invoice)
-        for invoice_name, invoice in invoice_groups:
-		
-            time.sleep(0.1) # remove or reduce value, added to sync with slower consumer
-            basket = {}
-            stockcodes = []
-            descriptions = []
-            quantities = []
-            unitprices = []
-			
-            # iterate over rows in this invoice dataframe
-            for row_index, row in invoice.iterrows():
-			
-                # these fields are the same for each row, so doesn't matter if we keep overwriting
-                basket['InvoiceNo'] = row['InvoiceNo']
-                basket['CustomerID'] = row['CustomerID']
-                basket['InvoiceDate'] = row['InvoiceDate']
-                basket['Country'] = row['Country']
-				
-                # these fields are different for each row, so we append to lists
-                stockcodes.append(row['StockCode'])
-                descriptions.append(row['Description'])
-                quantities.append(row['Quantity'])
-                unitprices.append(row['UnitPrice'])
-                basket['StockCodes'] = stockcodes
-                basket['Descriptions'] = descriptions
-                basket['Quantities'] = quantities
-                basket['UnitPrices'] = unitprices
-                
-		# produce each message (basket)
-                msgbytes = ujson.dumps(basket).encode('utf-8')
-                p.produce(recommender_system_topic, msgbytes)
-                print("produced basket " +str(invoice_name))
+        # streaming from local file instead, a chunk of the Parquet cache (or CSV) at a time 
+        # (the Excel file is only converted on first use or when it changes)
+        chunks = iter_retail_chunks(chunk_rows=args.chunk_rows)
+
+        # produce one message per complete basket as soon as its rows are read, shipping 
+        # the timestamp the consumer would otherwise parse for every basket
+        pacer = replayPacer(args.rate, args.speedup)
+        for basket in stream_baskets(chunks, timestamps=True):
+            pacer.wait(p, basket)
+            produce_basket(p, recommender_system_topic, basket, codec)
 
         p.flush()
         print("Done flushing")
-        time.sleep(15) # time to kill the producer so as not to duplicate data
+
+        # replays are harmless, baskets are indexed under their invoice numbers
+        if not args.loop:
+            break
 
 
@@ -0,0 +1,126 @@
+# !/usr/bin/env python
+
+"""
+author   : Marcelo Sanches
+doc name : Message codec
+purpose  : to encode baskets into Kafka messages and decode them back with a pluggable codec
+           (ujson, orjson or msgpack) shared by the producer and the consumers
+date     : 05.06.2019
+version  : 3.7.2
+"""
+
+# Import modules
+import os
+import ujson
+
+# optional faster codecs, used when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Kafka message headers naming the wire format and the basket schema version. Messages
+# without headers are legacy JSON baskets (schema 1, with an InvoiceDate string); schema 2
+# baskets carry an epoch-millis timestamp instead and are ready to index as they are.
+CODEC_HEADER = 'codec'
+SCHEMA_HEADER = 'schema'
+SCHEMA_VERSION = 2
+
+# codec used by the producer unless told otherwise
+DEFAULT_CODEC = os.environ.get('BASKET_CODEC', 'orjson' if orjson is not None else 'ujson')
+
+
+# Setup classes
+class messageCodec():
+    """This class pairs an encoder and a decoder with the wire format they produce ('json'
+       or 'msgpack'); codecs with the same wire format can read each other's messages.
+    """
+
+    def __init__(self, name, wire, dumps, loads):
+        self.name = name
+        self.wire = wire
+        self.dumps = dumps
+        self.loads = loads
+        self.headers = {schema: [(CODEC_HEADER, wire.encode('utf-8')),
+                                 (SCHEMA_HEADER, str(schema).encode('utf-8'))]
+                        for schema in (1, SCHEMA_VERSION)}
+
+    def encode(self, basket):
+        """Returns the message value and headers of a basket; baskets that already have
+           their timestamp are marked with the current schema version.
+        """
+        schema = SCHEMA_VERSION if 'timestamp' in basket and 'InvoiceDate' not in basket else 1
+
+        return self.dumps(basket), self.headers[schema]
+
+    def decode(self, value):
+        return self.loads(value)
+
+
+# Setup functions
+def available_codecs():
+    """Returns the codecs whose libraries are installed, by name.
+    """
+    codecs = {'ujson': messageCodec('ujson', 'json', lambda basket: ujson.dumps(basket).encode('utf-8'),
+                                    ujson.loads)}
+    if orjson is not None:
+        codecs['orjson'] = messageCodec('orjson', 'json', orjson.dumps, orjson.loads)
+    if msgpack is not None:
+        codecs['msgpack'] = messageCodec('msgpack', 'msgpack',
+                                         lambda basket: msgpack.packb(basket, use_bin_type=True),
+                                         lambda value: msgpack.unpackb(value, raw=False))
+
+    return codecs
+
+def get_codec(name):
+    """Returns a codec by name, raising ValueError if it is unknown or not installed.
+    """
+    if name not in CODECS:
+        raise ValueError("Codec " + str(name) + " is not available, choose one of "
+                         + ", ".join(sorted(CODECS)))
+
+    return CODECS[name]
+
+def message_format(msg):
+    """Returns the wire format and schema version of a Kafka message from its headers.
+    """
+    wire, schema = 'json', 1
+    for key, value in msg.headers() or ():
+        if key == CODEC_HEADER:
+            wire = value.decode('utf-8')
+        elif key == SCHEMA_HEADER:
+            schema = int(value)
+    if schema > SCHEMA_VERSION:
+        raise ValueError("Unsupported basket schema version " + str(schema))
+
+    return wire, schema
+
+def decode_msg(msg):
+    """Decodes a Kafka message into a basket with the decoder of its wire format.
+    """
+    wire, schema = message_format(msg)
+    if wire not in WIRE_DECODERS:
+        raise ValueError("No decoder installed for " + wire + " messages")
+
+    return WIRE_DECODERS[wire](msg.value())
+
+def bulk_source(msg):
+    """Returns the message bytes if they can go into a _bulk body as they are (a JSON basket
+       that already has its timestamp), or None if the message must be decoded first.
+    """
+    wire, schema = message_format(msg)
+    if wire == 'json' and schema >= 2:
+        return msg.value()
+
+    return None
+
+
+# codecs by name, and the fastest installed decoder of each wire format
+CODECS = available_codecs()
+WIRE_DECODERS = {'json': CODECS['orjson' if orjson is not None else 'ujson'].loads}
+if msgpack is not None:
+    WIRE_DECODERS['msgpack'] = CODECS['msgpack'].loads
@@ -0,0 +1,268 @@
+# !/usr/bin/env python
+
+"""
+author   : Marcelo Sanches
+doc name : Metrics
+purpose  : to count and time the hot paths of the producer, the consumer and the query tools,
+           exposing the results in the Prometheus text format or as periodic log lines
+date     : 05.06.2019
+version  : 3.7.2
+"""
+
+# Import modules
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# histogram bucket upper bounds in seconds, from 100 microseconds to 10 seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+
+
+# Setup classes
+class metric():
+    """This class holds the values of a metric for each combination of label values.
+    """
+
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def label_key(self, labels):
+        """Returns the sorted name/value pairs of labels, with every value as a string, so 
+           that values given as numbers (e.g. status codes, partitions) sort with the rest.
+        """
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    def label_text(self, labels, extra=()):
+        """Formats labels (sorted name/value pairs) as {name="value",...}.
+        """
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+
+        return '{' + ','.join('{}="{}"'.format(name, value) for name, value in pairs) + '}'
+
+
+class counter(metric):
+    """This class counts events, e.g. baskets produced or failed requests.
+    """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self):
+        return sum(self.values.values())
+
+    def render(self):
+        return ['{}{} {}'.format(self.name, self.label_text(labels), value)
+                for labels, value in sorted(self.values.items())]
+
+
+class gauge(counter):
+    """This class records the last value of a quantity, e.g. the consumer lag of a partition.
+    """
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.label_key(labels)] = value
+
+
+class histogram(metric):
+    """This class counts observations (e.g. request latencies) into cumulative buckets and
+       keeps their sum, so that rates, means and percentiles can be derived from it.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        metric.__init__(self, name, help)
+        self.buckets = list(buckets)
+
+    def observe(self, value, **labels):
+        key = self.label_key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        """Returns a context manager observing the time spent in its block.
+        """
+        return histogramTimer(self, labels)
+
+    def count(self):
+        return sum(entry[2] for entry in self.values.values())
+
+    def percentile(self, q):
+        """Estimates a percentile over all labels as the upper bound of the bucket it falls in.
+        """
+        counts = [0] * (len(self.buckets) + 1)
+        for entry in list(self.values.values()):
+            counts = [a + b for a, b in zip(counts, entry[0])]
+        n = sum(counts)
+        if n == 0:
+            return None
+        seen = 0
+        for bound, bucket_count in zip(self.buckets + [float('inf')], counts):
+            seen += bucket_count
+            if seen >= q * n:
+                return bound
+
+    def render(self):
+        lines = []
+        for labels, (counts, total, n) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{} {}'.format(self.name,
+                                                     self.label_text(labels, [('le', bound)]),
+                                                     cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, self.label_text(labels), total))
+            lines.append('{}_count{} {}'.format(self.name, self.label_text(labels), n))
+
+        return lines
+
+
+class histogramTimer():
+    """This class times a block of code into a histogram.
+    """
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class metricsRegistry():
+    """This class holds the metrics of a process, creating each on first use, and renders
+       them for the /metrics endpoint or as a one-line summary for the logs.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.last_summary = (self.start_time, {})
+
+    def get(self, kind, name, help, **kw):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = kind(name, help, **kw)
+
+            return self.metrics[name]
+
+    def counter(self, name, help=''):
+        return self.get(counter, name, help)
+
+    def gauge(self, name, help=''):
+        return self.get(gauge, name, help)
+
+    def histogram(self, name, help='', buckets=LATENCY_BUCKETS):
+        return self.get(histogram, name, help, buckets=buckets)
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, m in sorted(self.metrics.items()):
+            lines.append('# HELP {} {}'.format(name, m.help))
+            lines.append('# TYPE {} {}'.format(name, m.kind))
+            lines.extend(m.render())
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Returns a log line with the rate of every counter since the last summary, each
+           gauge, and the count and p50/p99 of every histogram.
+        """
+        now = time.time()
+        last_time, last_totals = self.last_summary
+        parts = []
+        totals = {}
+        for name, m in sorted(self.metrics.items()):
+            if m.kind == 'counter':
+                totals[name] = m.total()
+                rate = (totals[name] - last_totals.get(name, 0)) / max(now - last_time, 1e-9)
+                parts.append('{}={} ({:.1f}/s)'.format(name, totals[name], rate))
+            elif m.kind == 'gauge':
+                parts.append('{}={}'.format(name, m.total()))
+            elif m.count():
+                parts.append('{}: n={} p50<={}s p99<={}s'.format(name, m.count(),
+                                                                 m.percentile(0.5),
+                                                                 m.percentile(0.99)))
+        self.last_summary = (now, totals)
+
+        return ' | '.join(parts)
+
+
+# Setup functions
+def start_http_server(port, host='0.0.0.0', metrics=None):
+    """Serves the registry at http://host:port/metrics from a daemon thread.
+    """
+    metrics = metrics or registry
+
+    class metricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), metricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+def start_log_reporter(interval=10, metrics=None):
+    """Prints a summary of the registry every interval seconds from a daemon thread.
+    """
+    metrics = metrics or registry
+
+    def report():
+        while True:
+            time.sleep(interval)
+            print("metrics: " + metrics.summary())
+
+    threading.Thread(target=report, daemon=True).start()
+
+def start_reporting(port=None, interval=None):
+    """Starts the /metrics endpoint and/or the periodic log lines, as configured.
+    """
+    if port:
+        start_http_server(port)
+    if interval:
+        start_log_reporter(interval)
+
+
+# metrics of the whole process
+registry = metricsRegistry()
@@ -0,0 +1,266 @@
+# !/usr/bin/env python
+
+"""
+author   : Marcelo Sanches
+doc name : Product vocabulary
+purpose  : to keep the distinct product descriptions in memory and answer substring, prefix
+           and typo-tolerant lookups locally instead of querying Elasticsearch
+date     : 05.06.2019
+version  : 3.7.2
+"""
+
+# Import modules
+import bisect
+import time
+from ElasticsearchClient import get_client
+
+# milliseconds by which incremental sweeps overlap: baskets indexed just before a sweep may 
+# only become searchable after it (refresh interval, long bulk requests, clock skew)
+SWEEP_OVERLAP = 60000
+
+# most edits a fuzzy lookup allows, whatever its caller asks for: candidates must then share
+# trigrams with the text, or be of nearly its length, instead of being every description
+MAX_EDITS = 3
+
+
+# Setup functions
+def trigrams(text):
+    """Returns the set of three-character substrings of a text.
+    """
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def normalize(text):
+    """Collapses runs of whitespace, which product names are full of, into single spaces.
+    """
+    return ' '.join(text.split())
+
+def edit_distance(a, b, max_distance):
+    """Returns the number of insertions, deletions, substitutions and transpositions of
+       adjacent characters turning a into b, or max_distance + 1 as soon as it is known to
+       exceed max_distance.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if (i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+
+    return previous[-1]
+
+
+# Setup classes
+class productVocabulary():
+    """This class builds the set of distinct product descriptions once, by paging through a
+       composite aggregation, and indexes it in memory: a sorted list answers prefix queries
+       and a trigram inverted index answers substring queries, with descriptions grouped by
+       length for typo-tolerant lookups of short texts. Lookups refresh it first
+       unless auto_refresh is off, in which case the owner calls refresh() itself.
+    """
+
+    def __init__(self, index='recommender_system', field='Descriptions', page_size=1000,
+                 refresh_interval=30, auto_refresh=True, es=None):
+        self.index = index
+        self.es = es
+        self.auto_refresh = auto_refresh
+        self.field = field
+        self.page_size = page_size
+        self.refresh_interval = refresh_interval
+        self.products = []
+        self.postings = {}
+        self.normalized = {}
+        self.lengths = {}
+        self.doc_count = None
+        self.latest = None
+        self.indexed = None
+        self.last_refresh = 0
+
+    def sweep(self, since=None):
+        """Pages through a composite terms aggregation on the description field, optionally
+           restricted to baskets indexed at or after since (epoch millis). Returns the 
+           distinct descriptions, the latest basket timestamp and the latest indexing time
+           seen (all None on error).
+        """
+        query = {"size": 0,
+                 "aggs": {"products": {"composite": {
+                              "size": self.page_size,
+                              "sources": [{"description": {"terms": {"field": self.field}}}]}},
+                          "latest": {"max": {"field": "timestamp"}},
+                          "indexed": {"max": {"field": "indexed_at"}}}}
+        if since is not None:
+            query["query"] = {"range": {"indexed_at": {"gte": since}}}
+
+        terms = set()
+        latest = None
+        indexed = None
+        while True:
+            res = (self.es or get_client()).search(self.index, query)
+            if res is None:
+                print("Error reading product vocabulary")
+                return None, None, None
+
+            aggs = res["aggregations"]
+            if "latest" in aggs:
+                latest = aggs["latest"]["value"]
+                indexed = aggs["indexed"]["value"]
+            for bucket in aggs["products"]["buckets"]:
+                terms.add(bucket["key"]["description"])
+
+            # the next page starts after the last key of this one
+            after_key = aggs["products"].get("after_key")
+            if after_key is None or len(aggs["products"]["buckets"]) < self.page_size:
+                break
+            query["aggs"] = {"products": query["aggs"]["products"]}
+            query["aggs"]["products"]["composite"]["after"] = after_key
+
+        return terms, latest, indexed
+
+    def add(self, terms):
+        """Adds new descriptions to the sorted list, the trigram index and the length groups.
+        """
+        new_terms = set(terms).difference(self.products)
+        if not new_terms:
+            return
+
+        self.products = sorted(self.products + list(new_terms))
+        for term in new_terms:
+            self.normalized.setdefault(normalize(term), term)
+            self.lengths.setdefault(len(term), []).append(term)
+            for gram in trigrams(term):
+                self.postings.setdefault(gram, set()).add(term)
+
+    def count_docs(self):
+        """Returns the number of baskets in the index.
+        """
+        r = (self.es or get_client()).get("/{}/_count".format(self.index))
+        if r.status_code != 200:
+            return None
+
+        return r.json()["count"]
+
+    def refresh(self, force=False):
+        """Brings the vocabulary up to date. After the first full sweep, only baskets indexed 
+           since shortly before the latest indexing time seen are swept again (baskets arrive
+           out of invoice order, so their timestamps cannot be used), and nothing is swept 
+           at all while the index's document count is unchanged. Baskets indexed without an
+           indexing time make every sweep a full one. Unless forced, the index is checked at 
+           most once every refresh_interval seconds.
+        """
+        now = time.time()
+        if not force and now - self.last_refresh < self.refresh_interval:
+            return
+        self.last_refresh = now
+
+        doc_count = self.count_docs()
+        if doc_count is not None and doc_count == self.doc_count:
+            return
+
+        since = None if self.indexed is None else self.indexed - SWEEP_OVERLAP
+        terms, latest, indexed = self.sweep(since=since)
+        if terms is None:
+            return
+        self.add(terms)
+        self.doc_count = doc_count
+        if latest is not None:
+            self.latest = max(self.latest or 0, int(latest))
+        self.indexed = None if indexed is None else int(indexed)
+
+    def prefix(self, text, limit=None):
+        """Returns the descriptions starting with text, in alphabetical order.
+        """
+        if self.auto_refresh:
+            self.refresh()
+        i = bisect.bisect_left(self.products, text)
+        matches = []
+        while i < len(self.products) and self.products[i].startswith(text):
+            matches.append(self.products[i])
+            if limit is not None and len(matches) == limit:
+                break
+            i += 1
+
+        return matches
+
+    def substring(self, text, limit=None):
+        """Returns the descriptions containing text, in alphabetical order. Candidates are
+           the intersection of the text's trigram postings, checked for the full substring.
+        """
+        if self.auto_refresh:
+            self.refresh()
+        grams = trigrams(text)
+        if grams:
+            postings = sorted((self.postings.get(gram, set()) for gram in grams), key=len)
+            candidates = set.intersection(*postings)
+        else:
+            # texts shorter than three characters have no trigrams to look up
+            candidates = self.products
+
+        matches = sorted(product for product in candidates if text in product)
+
+        return matches[:limit] if limit is not None else matches
+
+    def fuzzy(self, text, limit=10, max_distance=None):
+        """Returns up to limit descriptions within max_distance edits of text (by default one
+           edit per five characters, at least one, and never more than MAX_EDITS), closest 
+           first. An edit changes at most four trigrams (a transposition of adjacent 
+           characters does, other edits three), so only descriptions sharing enough trigrams
+           with the text are compared with it; texts too short for that are only compared 
+           with descriptions of nearly their length.
+        """
+        if self.auto_refresh:
+            self.refresh()
+        text = normalize(text)
+        if max_distance is None:
+            max_distance = max(1, len(text) // 5)
+        max_distance = min(max_distance, MAX_EDITS)
+
+        grams = trigrams(text)
+        shared = {}
+        for gram in grams:
+            for term in list(self.postings.get(gram, ())):
+                shared[term] = shared.get(term, 0) + 1
+
+        # a text with more trigram positions than the edits can change (repeated trigrams 
+        # count once in grams) keeps at least one of them in every description close to it
+        min_shared = len(grams) - 4 * max_distance
+        if len(text) - 2 > 4 * max_distance:
+            candidates = [term for term, count in shared.items() if count >= max(min_shared, 1)]
+        else:
+            lengths = range(len(text) - max_distance, len(text) + max_distance + 1)
+            candidates = [term for length in lengths for term in list(self.lengths.get(length, ()))]
+
+        matches = []
+        for term in candidates:
+            distance = edit_distance(text, term, max_distance)
+            if distance <= max_distance:
+                matches.append((distance, -shared.get(term, 0), term))
+
+        return [term for distance, overlap, term in sorted(matches)[:limit]]
+
+    def resolve(self, text):
+        """Returns the description a user most likely meant: the description itself when the
+           text matches one up to whitespace, otherwise the closest description within the
+           default number of edits, or None. Before correcting the text, the vocabulary is
+           checked for products indexed since its last refresh (unless auto_refresh is off),
+           so that a new product is not mistaken for a typo of an older one.
+        """
+        if self.auto_refresh:
+            self.refresh()
+        canonical = self.normalized.get(normalize(text))
+        if canonical is None and self.auto_refresh:
+            self.refresh(force=True)
+            canonical = self.normalized.get(normalize(text))
+        if canonical is not None:
+            return canonical
+
+        matches = self.fuzzy(text, limit=1)
+
+        return matches[0] if matches else None
@@ -9,20 +9,218 @@ version  : 3.7.2
 """
 
 # Import modules
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
 from prettytable import PrettyTable
+from ElasticsearchClient import doc_path, get_client
+from Metrics import registry, start_http_server
+from ProductVocabulary import productVocabulary
+from RecommendationSnapshot import recommendationSnapshot
+
+# recommendation cache size (entries) and time to live (seconds), overridable through the environment
+QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE', 1024))
+QUERY_CACHE_TTL = float(os.environ.get('QUERY_CACHE_TTL', 300))
+
+# precomputed recommendations, used before querying Elasticsearch if the file exists
+RECOMMENDATION_SNAPSHOT = os.environ.get('RECOMMENDATION_SNAPSHOT', 'recommendations.snap')
+
+# index of recommendations precomputed by RecommendationIndex.py, looked up by product name
+RECOMMENDATIONS_INDEX = os.environ.get('RECOMMENDATIONS_INDEX', 'recommendations')
+
+# seconds between checks of whether the recommendation index exists
+RECOMMENDATIONS_CHECK_INTERVAL = 60
+
+# recommendation query mode, overridable through the environment: a time window in
+# Elasticsearch date math (e.g. 90d) restricting the baskets aggregated, unset for the full
+# history; a sampler ('sampler', or 'diversified' for at most one basket per customer)
+# aggregating only the shard_size best matching baskets per shard; and the bucket options
+QUERY_WINDOW = os.environ.get('QUERY_WINDOW') or None
+QUERY_SAMPLER = os.environ.get('QUERY_SAMPLER') or None
+QUERY_SHARD_SIZE = int(os.environ.get('QUERY_SHARD_SIZE', 500))
+QUERY_MIN_DOC_COUNT = int(os.environ.get('QUERY_MIN_DOC_COUNT', 10))
+QUERY_SIZE = int(os.environ.get('QUERY_SIZE', 10))
+
+# query metrics, latency labeled by where the answer came from (snapshot, index, cache, elasticsearch)
+query_latency = registry.histogram('query_seconds', 'Recommendation query latency')
+cache_hits = registry.counter('query_cache_hits_total', 'Queries answered from the cache')
+cache_misses = registry.counter('query_cache_misses_total', 'Queries not found in the cache')
+
+# Setup classes 
+class queryCache():
+    """This class caches query responses (TTL + LRU) keyed by index, normalized user input 
+       and query body. The cache is cleared whenever the index's searchable documents or 
+       indexing count change, so that newly consumed baskets show up in recommendations.
+    """
+
+    def __init__(self, size=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL, check_interval=5):
+        self.size = size
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.last_check = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, index, query, userinput):
+        """Builds a cache key from the index, the normalized user input and the query body.
+        """
+        return (index, str(userinput).upper().strip(), json.dumps(query, sort_keys=True))
+
+    def index_generation(self, index):
+        """Returns the live and deleted document counts of an index, which change when new or 
+           replaced baskets become searchable, and its indexing count. The refresh count is 
+           not used: it grows with every scheduled refresh, even when nothing changed.
+        """
+        r = get_client().get("/{}/_stats/docs,indexing".format(index))
+        if r.status_code != 200:
+            return None
+        try:
+            stats = r.json()["_all"]["primaries"]
+            return (stats["docs"]["count"], stats["docs"]["deleted"], 
+                    stats["indexing"]["index_total"])
+        except (KeyError, ValueError):
+            return None
+
+    def check_generation(self, index):
+        """Clears the cache if the index changed since it was last checked; the index is 
+           checked at most once every check_interval seconds.
+        """
+        now = time.time()
+        if now - self.last_check.get(index, 0) < self.check_interval:
+            return
+        self.last_check[index] = now
+
+        generation = self.index_generation(index)
+        if generation != self.generations.get(index):
+            with self.lock:
+                for key in [key for key in self.entries if key[0] == index]:
+                    del self.entries[key]
+            self.generations[index] = generation
+
+    def get(self, key):
+        """Returns a cached response, or None if it is missing or expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                self.misses += 1
+                cache_misses.inc()
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            cache_hits.inc()
+
+            return entry[1]
+
+    def put(self, key, res):
+        """Caches a response, evicting the least recently used one if the cache is full.
+        """
+        with self.lock:
+            self.entries[key] = (time.time(), res)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        """Returns hit/miss counters and the current number of entries.
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries),
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
 
 # Setup functions
-def execute_es_query(index, query, userinput):
-    """Executes an Elasticsearch query given an index, a query type (in Lucene), 
-    and a string provided by the user to query the index.
+def get_snapshot():
+    """Returns the memory-mapped recommendation snapshot, or None if none was published.
+    """
+    global recommendation_snapshot
+    if recommendation_snapshot is None and os.path.isfile(RECOMMENDATION_SNAPSHOT):
+        recommendation_snapshot = recommendationSnapshot(RECOMMENDATION_SNAPSHOT)
+
+    return recommendation_snapshot
+
+def correlated_buckets(res):
+    """Returns the significant_terms buckets of a recommendation query response, sampled 
+       or not.
+    """
+    aggs = res['aggregations']
+    if 'sample' in aggs:
+        aggs = aggs['sample']
+
+    return aggs['correlated_words']['buckets']
+
+def latest_timestamp(index='recommender_system'):
+    """Returns the timestamp (epoch millis) of the latest basket of an index, at which time
+       windows end, or None if it has none.
     """
-    r = requests.get("http://elasticsearch:9200/{}/_search".format(index), json=query)
+    res = get_client().search(index, {"size": 0, "aggs": {"latest": {"max": {"field": "timestamp"}}}})
+    if res is None or res["aggregations"]["latest"]["value"] is None:
+        return None
+
+    return int(res["aggregations"]["latest"]["value"])
+
+def recommendations_indexed(index=RECOMMENDATIONS_INDEX):
+    """Returns whether the recommendation index exists, checking at most once every 
+       RECOMMENDATIONS_CHECK_INTERVAL seconds, so that queries only look products up in it 
+       once RecommendationIndex.py has built it.
+    """
+    exists, last_check = recommendations_checks.get(index, (False, 0))
+    now = time.time()
+    if now - last_check >= RECOMMENDATIONS_CHECK_INTERVAL:
+        try:
+            exists = get_client().head('/{}'.format(index)).status_code == 200
+        except requests.exceptions.RequestException:
+            exists = False
+        recommendations_checks[index] = (exists, now)
+
+    return exists
+
+def get_precomputed(product, index=RECOMMENDATIONS_INDEX):
+    """Returns the precomputed also-bought list of a product with a single get by id, or
+       None if the product (or the recommendation index) is not there.
+    """
+    if not recommendations_indexed(index):
+        return None
+    try:
+        r = get_client().get(doc_path(index, product))
+    except requests.exceptions.RequestException:
+        return None
     if r.status_code != 200:
-        print("Error executing query")
         return None
+
+    return r.json()["_source"]["also_bought"]
+
+def execute_es_query(index, query, userinput, cache=None):
+    """Executes an Elasticsearch query given an index, a query type (in Lucene), 
+    and a string provided by the user to query the index. Responses are served from 
+    the recommendation cache when possible.
+    """
+    start = time.perf_counter()
+    cache = cache or query_cache
+    cache.check_generation(index)
+    key = cache.key(index, query, userinput)
+    res = cache.get(key)
+    if res is not None:
+        query_latency.observe(time.perf_counter() - start, source='cache')
+        return res
+
+    res = get_client().search(index, query)
+    if res is None:
+        print("Error executing query")
     else:
-        return r.json()
+        cache.put(key, res)
+    query_latency.observe(time.perf_counter() - start, source='elasticsearch')
+
+    return res
 
 def sanitize(input_string):
     """Basic sanitization of input against script tags (< >).
@@ -40,36 +238,67 @@ def sanitize(input_string):
     return output_string
 
 	
-# Setup classes 
 class queryType():
     """This class handles different types of Elasticsearch queries the system makes.
+       Recommendation queries aggregate the full history unless given a time window ending 
+       at end (epoch millis of the latest basket, or now if None) and can be sampled.
     """
 	
-    def __init__(self, userinput):
+    def __init__(self, userinput, window=QUERY_WINDOW, end=None, sampler=QUERY_SAMPLER, 
+                 shard_size=QUERY_SHARD_SIZE, min_doc_count=QUERY_MIN_DOC_COUNT, size=QUERY_SIZE):
+        if sampler not in (None, 'sampler', 'diversified'):
+            raise ValueError("Unknown sampler " + str(sampler) + ", choose sampler or diversified")
         self.userinput = userinput
+        self.window = window
+        self.end = end
+        self.sampler = sampler
+        self.shard_size = shard_size
+        self.min_doc_count = min_doc_count
+        self.size = size
+
+    def window_filter(self):
+        """Returns the range filter of the baskets in the time window, rounded down to the 
+           minute so that repeated queries hit the shard request cache.
+        """
+        end = 'now' if self.end is None else str(int(self.end)) + '||'
+
+        return {"range": {"timestamp": {"gte": end + "-" + self.window + "/m"}}}
 
     def query_descriptions(self):
         """Queries descriptions that match a user input and aggregate, count, and 
-           returns the significant descriptions with counts above 10.
+           returns the significant descriptions with counts above min_doc_count. With a
+           window, both the baskets with the product and the background they are compared
+           with are the baskets of the window; with a sampler, the aggregation is nested
+           under a 'sample' aggregation (see correlated_buckets).
         """
+        significant_terms = {
+            "field": "Descriptions",
+            "exclude": self.userinput,
+            "min_doc_count": self.min_doc_count,
+            "size": self.size
+        }
+        filters = [{"term": {"Descriptions": self.userinput}}]
+        if self.window is not None:
+            filters.append(self.window_filter())
+            significant_terms["background_filter"] = self.window_filter()
+
+        aggs = {"correlated_words": {"significant_terms": significant_terms}}
+        if self.sampler == 'sampler':
+            aggs = {"sample": {"sampler": {"shard_size": self.shard_size}, "aggs": aggs}}
+        elif self.sampler == 'diversified':
+            aggs = {"sample": {"diversified_sampler": {"shard_size": self.shard_size,
+                                                       "field": "CustomerID",
+                                                       "max_docs_per_value": 1},
+                               "aggs": aggs}}
+
         query_descriptions = {
             "size": 0,
             "query": {
                 "bool": {
-                    "filter": [
-                        {"term": {"Descriptions": self.userinput}},
-                    ]
+                    "filter": filters
                 }
             },
-            "aggs": {
-                "correlated_words": {
-                    "significant_terms": {
-                        "field": "Descriptions",
-                        "exclude": self.userinput,
-                        "min_doc_count": 10
-                    }
-                }
-            }
+            "aggs": aggs
         }
 
         return query_descriptions
@@ -103,11 +332,37 @@ class queryUserinput():
         userinput = sanitize(input("Please Enter Your Product To Query: "))
         userinput = userinput.upper().strip()
 
-        # queries Elasticsearch
-        Q =  queryType(userinput)
+        # resolves typos and spacing to the product name the user most likely meant; input
+        # close to no known product is still queried as typed
+        resolved = product_vocabulary.resolve(userinput)
+        if resolved is not None and resolved != userinput:
+            print("Showing results for " + resolved)
+            userinput = resolved
+
+        # answers from the precomputed recommendations, which cover the whole history, unless
+        # a time window or a sampler is configured
+        if QUERY_WINDOW is None and QUERY_SAMPLER is None:
+            # from the snapshot if the product is in it
+            snapshot = get_snapshot()
+            if snapshot is not None:
+                start = time.perf_counter()
+                also_bought = snapshot.recommend(userinput)
+                if also_bought:
+                    query_latency.observe(time.perf_counter() - start, source='snapshot')
+                    return (userinput, also_bought)
+
+            # or from the recommendation index if the product was precomputed with results
+            start = time.perf_counter()
+            also_bought = get_precomputed(userinput)
+            if also_bought:
+                query_latency.observe(time.perf_counter() - start, source='index')
+                return (userinput, also_bought)
+
+        # otherwise queries Elasticsearch
+        Q =  queryType(userinput, end=product_vocabulary.latest)
         query = Q.query_descriptions()
         res = execute_es_query('recommender_system', query, userinput)
-        buckets_list = res['aggregations']['correlated_words']['buckets']
+        buckets_list = correlated_buckets(res)
 
         # populates a list of recommendations with counts 
         also_bought = []
@@ -143,28 +398,26 @@ class prettyResponse():
         """For a wrong product name, displays a table of products that one might 
            want to use as in a query.
         """
+        userinput = self.userinput
         print(" "*100); print("_"*100); print(" "*100)
         print("The item " +userinput +" does not appear to be in our list of products.")
         print(" "*100)
         print("Here are some products we have that you could use in your query: ")
         print(" "*100)
         
-        # query Elasticsearch again for products containing keywords in the user input
-        Q = queryType(userinput)
-        query = Q.query_all()
-        res = execute_es_query('recommender_system', query, userinput)
+        # look up current product names containing the user input in the local vocabulary
+        products_list = product_vocabulary.substring(userinput)
+        header = "Products Containing " + userinput
 
-        # build list of current product names to choose from
-        products_list = []
-        for hit in res['hits']['hits']:
-            for description in hit['_source']['Descriptions']:
-                if userinput in description:
-                    products_list.append(description)
+        # otherwise offers the product names closest to it
+        if not products_list:
+            products_list = product_vocabulary.fuzzy(userinput, limit=10, max_distance=
+                                                     max(2, len(userinput) // 3))
+            header = "Products Similar To " + userinput
 
-        # remove duplicates and build pretty table
+        # build pretty table
         x = PrettyTable()
-        x.field_names = ["Products Containing "+userinput]
-        products_list = list(set(products_list))
+        x.field_names = [header]
         for item in products_list:
             x.add_row([item])
         print(x); print(" "*100)
@@ -172,6 +425,7 @@ class prettyResponse():
     def not_found_end(self):
         """Message received after four unsuccessful attempts.
         """
+        userinput = self.userinput
         print(" "*100); print("_"*100); print(" "*100)
         print("The item " +userinput +" does not appear to be in our list of products.")
         print(" "*100)
@@ -179,9 +433,107 @@ class prettyResponse():
         print(" "*100)		
 
 
+# Batch functions
+def msearch_chunk(index, products, end=None):
+    """Runs the recommendation query of each product in one _msearch request and returns a 
+       result per product: its also-bought list, or an error that does not affect the others.
+       Time windows end at end (the latest basket), or now if None.
+    """
+    queries = [queryType(product, end=end).query_descriptions() for product in products]
+    try:
+        res = get_client().msearch(index, queries)
+    except requests.exceptions.RequestException as e:
+        return [{"product": product, "error": str(e)} for product in products]
+    if res is None:
+        return [{"product": product, "error": "_msearch request failed"} for product in products]
+
+    results = []
+    for product, query, response in zip(products, queries, res["responses"]):
+        if "error" in response:
+            results.append({"product": product, "error": response["error"]})
+            continue
+
+        # warm the recommendation cache for interactive queries
+        query_cache.put(query_cache.key(index, query, product), response)
+        buckets_list = correlated_buckets(response)
+        results.append({"product": product, 
+                        "also_bought": [[bucket['key'], bucket['doc_count']] for bucket in buckets_list]})
+
+    return results
+
+def batch_recommend(products, index='recommender_system', batch_size=50, concurrency=4):
+    """Yields recommendations for many products, packing batch_size queries per _msearch 
+       request with up to concurrency requests in flight. Results are yielded as soon as 
+       their request completes, so their order may differ from the input order.
+    """
+    products = [sanitize(product).upper().strip() for product in products]
+    products = [product for product in products if product]
+    chunks = [products[i:i + batch_size] for i in range(0, len(products), batch_size)]
+
+    # time windows end at the latest basket, which replayed data dates in the past
+    end = latest_timestamp(index) if QUERY_WINDOW is not None else None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(msearch_chunk, index, chunk, end) for chunk in chunks]
+        for future in as_completed(futures):
+            for result in future.result():
+                yield result
+
+def batch_cli(args):
+    """Reads product names (one per line) from a file or stdin and writes recommendations 
+       to a file or stdout as JSON lines.
+    """
+    infile = sys.stdin if args.batch == '-' else open(args.batch)
+    outfile = sys.stdout if args.output == '-' else open(args.output, 'w')
+    with infile, outfile:
+        products = [line.rstrip('\n') for line in infile]
+        errors = 0
+        for result in batch_recommend(products, 'recommender_system', args.batch_size, 
+                                      args.concurrency):
+            errors += "error" in result
+            outfile.write(json.dumps(result) + "\n")
+            outfile.flush()
+
+    print("{} products, {} errors".format(len(products), errors), file=sys.stderr)
+
+
+# recommendation cache shared by all queries of this process
+query_cache = queryCache()
+
+# distinct product descriptions, swept from the index on first use
+product_vocabulary = productVocabulary('recommender_system')
+
+# memory-mapped recommendation snapshot, see get_snapshot
+recommendation_snapshot = None
+
+# whether each recommendation index existed when last checked, and when, see recommendations_indexed
+recommendations_checks = {}
+
+
 # Run
 if __name__ == "__main__":
 
+    # command line options
+    parser = argparse.ArgumentParser(description="Query product recommendations")
+    parser.add_argument("--batch", default=None,
+                        help="file of product names, one per line ('-' for stdin), to score in batch")
+    parser.add_argument("--output", default="-",
+                        help="JSON lines output file of the batch mode (default: stdout)")
+    parser.add_argument("--batch-size", type=int, default=50,
+                        help="queries per _msearch request (default: 50)")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="_msearch requests in flight (default: 4)")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics at http://0.0.0.0:PORT/metrics")
+    args = parser.parse_args()
+
+    if args.metrics_port:
+        start_http_server(args.metrics_port)
+
+    if args.batch:
+        batch_cli(args)
+        sys.exit()
+
     # get user input, return list of recommendations
     UI = queryUserinput()
     (userinput, also_bought) = UI.user_query()
@@ -0,0 +1,135 @@
+# !/usr/bin/env python
+
+"""
+author   : Marcelo Sanches
+doc name : Recommendation index builder
+purpose  : to precompute the recommendations of every product and write them to a serving
+           index keyed by product, recomputing only products bought since the last run
+date     : 05.06.2019
+version  : 3.7.2
+"""
+
+# Import modules
+import argparse
+import time
+from ElasticsearchClient import bulk_body, bulk_errors, create_index, get_client
+from ProductVocabulary import SWEEP_OVERLAP, productVocabulary
+from QueryElasticsearch import RECOMMENDATIONS_INDEX, batch_recommend
+
+# mapping of recommendation documents: looked up by id only, so nothing but the product is
+# indexed, and the _meta field records the latest indexing time covered by the last run
+RECOMMENDATIONS_MAPPING = {"dynamic": False,
+                           "properties": {"product": {"type": "keyword"},
+                                          "also_bought": {"type": "object", "enabled": False},
+                                          "computed_at": {"type": "date", "format": "epoch_millis"}}}
+
+
+# Setup functions
+def check_recommendations_index(target=RECOMMENDATIONS_INDEX, es=None):
+    """Creates the recommendation index with its mapping if it does not exist yet.
+    """
+    es = es or get_client()
+    if es.head('/{}'.format(target)).status_code != 200:
+        create_index(target, {"settings": {"number_of_shards": 1},
+                              "mappings": RECOMMENDATIONS_MAPPING}, es)
+
+def last_run(target=RECOMMENDATIONS_INDEX, es=None):
+    """Returns the latest basket indexing time (epoch millis) covered by the last run, or 
+       None if there was none.
+    """
+    r = (es or get_client()).get('/{}/_mapping'.format(target))
+    if r.status_code != 200:
+        return None
+
+    # the response is keyed by the concrete index name
+    mapping = list(r.json().values())[0]["mappings"]
+
+    return mapping.get("_meta", {}).get("indexed")
+
+def record_run(indexed, target=RECOMMENDATIONS_INDEX, es=None):
+    """Stores the latest basket indexing time covered by this run in the index mapping.
+    """
+    r = (es or get_client()).put('/{}/_mapping'.format(target), {"_meta": {"indexed": indexed}})
+    if r.status_code != 200:
+        print("Error recording the run: " + r.text)
+
+def write_recommendations(results, target=RECOMMENDATIONS_INDEX, chunk_size=500, es=None):
+    """Bulk-indexes recommendation results under their product names, replacing those of an
+       earlier run. Returns the number of products written and the number of failures.
+    """
+    es = es or get_client()
+    now = int(time.time() * 1000)
+    written, failed = 0, 0
+    for i in range(0, len(results), chunk_size):
+        docs = [{"product": result["product"], "also_bought": result["also_bought"],
+                 "computed_at": now} for result in results[i:i + chunk_size]]
+        r = es.bulk('/{}/_bulk'.format(target), bulk_body(docs, [doc["product"] for doc in docs]))
+        if r.status_code != 200:
+            print("Error writing recommendations: " + r.text)
+            failed += len(docs)
+            continue
+        errors = len(bulk_errors(docs, r.json()))
+        written += len(docs) - errors
+        failed += errors
+
+    return written, failed
+
+def build_recommendations(index='recommender_system', target=RECOMMENDATIONS_INDEX, full=False,
+                          batch_size=50, concurrency=4, es=None):
+    """Recomputes the recommendations of the products found in baskets indexed since the 
+       last run (every product on the first run, or if full), with the significant_terms 
+       query of the query tool, and writes them to the target index. Baskets are found by
+       the time they were indexed, not by their invoice dates, since late baskets can carry
+       older dates; runs overlap slightly to cover baskets not yet searchable at the last one.
+       Recommendations of other products are kept as they are, although new baskets also
+       shift their background counts slightly; a full run brings them all up to date.
+    """
+    es = es or get_client()
+    check_recommendations_index(target, es)
+    since = None if full else last_run(target, es)
+    if since is not None:
+        since -= SWEEP_OVERLAP
+
+    start = time.time()
+    products, latest, indexed = productVocabulary(index, auto_refresh=False, es=es).sweep(since=since)
+    if products is None:
+        return
+    if not products:
+        print("No baskets since the last run")
+        return
+
+    results = []
+    errors = 0
+    for result in batch_recommend(sorted(products), index, batch_size, concurrency):
+        if "error" in result:
+            errors += 1
+            print("Error recommending " + result["product"] + ": " + str(result["error"]))
+        else:
+            results.append(result)
+    written, failed = write_recommendations(results, target, es=es)
+
+    # the next run starts from this one's latest basket only if nothing was missed
+    if indexed is not None and errors + failed == 0:
+        record_run(int(indexed), target, es)
+    es.post('/{}/_refresh'.format(target))
+
+    print("{} products recomputed, {} written, {} errors in {:.1f} s".format(
+        len(products), written, errors + failed, time.time() - start))
+
+
+# Run
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute recommendations into a serving index")
+    parser.add_argument("--index", default="recommender_system",
+                        help="basket index or alias (default: recommender_system)")
+    parser.add_argument("--target", default=RECOMMENDATIONS_INDEX,
+                        help="recommendation index (default: " + RECOMMENDATIONS_INDEX + ")")
+    parser.add_argument("--full", action="store_true",
+                        help="recompute every product instead of those in baskets indexed since the last run")
+    parser.add_argument("--batch-size", type=int, default=50,
+                        help="queries per _msearch request (default: 50)")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="_msearch requests in flight (default: 4)")
+    args = parser.parse_args()
+
+    build_recommendations(args.index, args.target, args.full, args.batch_size, args.concurrency)
@@ -0,0 +1,184 @@
+# !/usr/bin/env python
+
+"""
+author   : Marcelo Sanches
+doc name : Recommendation service
+purpose  : to serve product recommendations and product name suggestions over HTTP
+date     : 05.06.2019
+version  : 3.7.2
+"""
+
+# Import modules
+import argparse
+import asyncio
+import itertools
+import aiohttp
+from aiohttp import web
+from ElasticsearchClient import DEFAULT_HOSTS, DEFAULT_TIMEOUT, esClient
+from Metrics import registry
+from ProductVocabulary import productVocabulary
+from QueryElasticsearch import correlated_buckets, queryType, sanitize
+
+# service metrics
+request_latency = registry.histogram('service_request_seconds', 'HTTP request latency by endpoint')
+coalesced = registry.counter('service_coalesced_requests_total',
+                             'Requests that joined an identical query in flight')
+
+
+# Setup classes
+class recommendationService():
+    """This class serves /recommend?item= with the significant_terms query of queryType and
+       /suggest?q= from the in-memory product vocabulary. Elasticsearch is queried through a
+       pooled aiohttp session, and identical requests arriving while a query is in flight
+       share that query instead of sending their own.
+    """
+
+    def __init__(self, index='recommender_system', hosts=None, pool_size=100,
+                 timeout=DEFAULT_TIMEOUT, refresh_interval=30):
+        self.index = index
+        self.hosts = [host.rstrip('/') for host in (hosts or DEFAULT_HOSTS)]
+        self.next_host = itertools.cycle(self.hosts)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.refresh_interval = refresh_interval
+        self.vocabulary = productVocabulary(index, auto_refresh=False,
+                                            es=esClient(self.hosts, timeout, retries=1))
+        self.inflight = {}
+        self.upstream_queries = 0
+        self.coalesced_requests = 0
+
+    async def start(self, app):
+        """Opens the Elasticsearch connection pool and starts refreshing the vocabulary.
+        """
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.pool_size),
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self.refresher = asyncio.ensure_future(self.refresh_vocabulary())
+
+    async def stop(self, app):
+        """Stops refreshing the vocabulary and closes the connection pool.
+        """
+        self.refresher.cancel()
+        await self.session.close()
+
+    async def refresh_vocabulary(self):
+        """Refreshes the vocabulary in a worker thread every refresh_interval seconds, so the
+           blocking sweep never holds up requests.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.vocabulary.refresh, True)
+            except Exception as e:
+                print("Error refreshing product vocabulary: " + str(e))
+            await asyncio.sleep(self.refresh_interval)
+
+    async def search(self, query):
+        """Runs a search on the next Elasticsearch host and returns the parsed response.
+        """
+        self.upstream_queries += 1
+        url = "{}/{}/_search".format(next(self.next_host), self.index)
+        async with self.session.post(url, json=query) as r:
+            if r.status != 200:
+                raise web.HTTPBadGateway(text="Elasticsearch returned status " + str(r.status))
+            return await r.json()
+
+    async def coalesce(self, key, query):
+        """Returns the response of a query, joining an identical query already in flight.
+        """
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.search(query))
+            self.inflight[key] = future
+            future.add_done_callback(lambda done: self.inflight.pop(key, None))
+        else:
+            self.coalesced_requests += 1
+            coalesced.inc()
+
+        # shield the shared query from the cancellation of any single request
+        return await asyncio.shield(future)
+
+    async def recommend(self, request):
+        """GET /recommend?item=PRODUCT NAME -> {"item": ..., "also_bought": [[product, count], ...]},
+           where item is the product name the input was resolved to.
+        """
+        item = sanitize(request.query.get('item', '')).upper().strip()
+        if not item:
+            raise web.HTTPBadRequest(text="missing item")
+
+        with request_latency.time(endpoint='recommend'):
+            # typos are resolved to the closest product name, unknown products queried as typed;
+            # vocabulary lookups run in a worker thread so they never hold up other requests
+            loop = asyncio.get_event_loop()
+            item = await loop.run_in_executor(None, self.vocabulary.resolve, item) or item
+
+            query = queryType(item, end=self.vocabulary.latest).query_descriptions()
+            try:
+                res = await self.coalesce(item, query)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise web.HTTPBadGateway(text="Error querying Elasticsearch: " + str(e))
+            buckets_list = correlated_buckets(res)
+
+            return web.json_response({"item": item, "also_bought": [[bucket['key'], bucket['doc_count']]
+                                                                 for bucket in buckets_list]})
+
+    async def suggest(self, request):
+        """GET /suggest?q=TEXT[&limit=N] -> {"q": ..., "products": [...]} of product names
+           containing the text, or of the names closest to it if none does.
+        """
+        text = sanitize(request.query.get('q', '')).upper().strip()
+        if not text:
+            raise web.HTTPBadRequest(text="missing q")
+        limit = int(request.query.get('limit', 20))
+
+        with request_latency.time(endpoint='suggest'):
+            loop = asyncio.get_event_loop()
+            products = await loop.run_in_executor(None, self.lookup, text, limit)
+
+            return web.json_response({"q": text, "products": products})
+
+    def lookup(self, text, limit):
+        """Returns up to limit product names containing text, or the names closest to it if 
+           none does.
+        """
+        return (self.vocabulary.substring(text, limit)
+                or self.vocabulary.fuzzy(text, limit, max_distance=max(2, len(text) // 3)))
+
+    async def stats(self, request):
+        """GET /stats -> upstream queries and coalesced requests so far.
+        """
+        return web.json_response({"upstream_queries": self.upstream_queries,
+                                  "coalesced_requests": self.coalesced_requests})
+
+    async def metrics(self, request):
+        """GET /metrics -> the process metrics in the Prometheus text format.
+        """
+        return web.Response(text=registry.render(), content_type='text/plain')
+
+
+# Setup functions
+def make_app(service):
+    """Builds the aiohttp application around a recommendation service.
+    """
+    app = web.Application()
+    app.router.add_get('/recommend', service.recommend)
+    app.router.add_get('/suggest', service.suggest)
+    app.router.add_get('/stats', service.stats)
+    app.router.add_get('/metrics', service.metrics)
+    app.on_startup.append(service.start)
+    app.on_cleanup.append(service.stop)
+
+    return app
+
+
+# Run
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve product recommendations over HTTP")
+    parser.add_argument("--host", default="0.0.0.0", help="address to listen on (default: 0.0.0.0)")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on (default: 8080)")
+    parser.add_argument("--pool-size", type=int, default=100,
+                        help="maximum connections to Elasticsearch (default: 100)")
+    args = parser.parse_args()
+
+    web.run_app(make_app(recommendationService(pool_size=args.pool_size)),
+                host=args.host, port=args.port)
@@ -0,0 +1,157 @@
+# !/usr/bin/env python
+
+"""
+author   : Marcelo Sanches
+doc name : Recommendation snapshot
+purpose  : to publish precomputed recommendations in a versioned binary file that the query tool
+           memory-maps, so that it starts and serves in milliseconds
+date     : 05.06.2019
+version  : 3.7.2
+"""
+
+# Import modules
+import json
+import os
+import struct
+import time
+import numpy as np
+
+# file layout: magic, header length (uint32), JSON header, then 64-byte aligned arrays
+SNAPSHOT_MAGIC = b'RECSNAP\x00'
+SNAPSHOT_VERSION = 1
+ALIGNMENT = 64
+
+
+# Setup functions
+def write_snapshot(model, path):
+    """Writes a cooccurrenceModel to a snapshot file: the item dictionary (UTF-8 names with
+       offsets, plus item ids in name order for binary search), the CSR offsets and the top-K
+       neighbors, scores and counts. The file is written under a temporary name and renamed,
+       so readers always see either the old or the new snapshot.
+    """
+    encoded = [item.encode('utf-8') for item in model.items]
+    item_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    item_offsets[1:] = np.cumsum([len(item) for item in encoded])
+    arrays = [('item_offsets', item_offsets),
+              ('item_bytes', np.frombuffer(b''.join(encoded), dtype=np.uint8)),
+              ('item_order', np.argsort(np.asarray(encoded, dtype=object)).astype(np.int32)),
+              ('offsets', np.asarray(model.offsets, dtype=np.int64)),
+              ('neighbors', np.asarray(model.neighbors, dtype=np.int32)),
+              ('scores', np.asarray(model.scores, dtype=np.float32)),
+              ('counts', np.asarray(model.counts, dtype=np.int32))]
+
+    # array positions are relative to the end of the header, which is padded to ALIGNMENT
+    layout = {}
+    position = 0
+    for name, array in arrays:
+        layout[name] = {'offset': position, 'dtype': array.dtype.str, 'length': len(array)}
+        position += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({'version': SNAPSHOT_VERSION, 'n_items': len(encoded),
+                         'n_baskets': int(model.n_baskets), 'created': time.time(),
+                         'arrays': layout}).encode('utf-8')
+    start = -(-(len(SNAPSHOT_MAGIC) + 4 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for name, array in arrays:
+            f.seek(start + layout[name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(start + position)
+    os.replace(tmp, path)
+
+
+# Setup classes
+class recommendationSnapshot():
+    """This class memory-maps a snapshot file and answers recommendations straight from the
+       mapped arrays: product names are found by binary search over the item ids in name
+       order, so nothing but the small header is read into the heap on startup.
+    """
+
+    def __init__(self, path, check_interval=5):
+        self.path = path
+        self.check_interval = check_interval
+        self.open()
+
+    def open(self):
+        """Maps the current snapshot file and checks its version.
+        """
+        self.stat = os.stat(self.path)
+        self.last_check = time.time()
+        # a plain ndarray view of the mapping is much faster to index than an np.memmap
+        self.mm = np.memmap(self.path, dtype=np.uint8, mode='r').view(np.ndarray)
+        if bytes(self.mm[:len(SNAPSHOT_MAGIC)]) != SNAPSHOT_MAGIC:
+            raise ValueError(self.path + " is not a recommendation snapshot")
+
+        header_length = struct.unpack('<I', bytes(self.mm[8:12]))[0]
+        self.header = json.loads(bytes(self.mm[12:12 + header_length]).decode('utf-8'))
+        if self.header['version'] != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported snapshot version " + str(self.header['version']))
+
+        start = -(-(12 + header_length) // ALIGNMENT) * ALIGNMENT
+        for name, spec in self.header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            offset = start + spec['offset']
+            setattr(self, name, self.mm[offset:offset + spec['length'] * dtype.itemsize].view(dtype))
+        self.n_items = self.header['n_items']
+
+        # the item dictionary is searched one element at a time, which is faster on memoryviews
+        self.item_offsets_view = memoryview(self.item_offsets)
+        self.item_order_view = memoryview(self.item_order)
+        self.item_bytes_view = memoryview(self.item_bytes)
+
+    def maybe_reload(self):
+        """Remaps the file if a new snapshot was published since it was opened; checked at most
+           once every check_interval seconds.
+        """
+        now = time.time()
+        if now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+        stat = os.stat(self.path)
+        if (stat.st_ino, stat.st_mtime_ns) != (self.stat.st_ino, self.stat.st_mtime_ns):
+            self.open()
+
+    def item_name(self, i):
+        """Returns the UTF-8 encoded name of item i.
+        """
+        offsets = self.item_offsets_view
+        return self.item_bytes_view[offsets[i]:offsets[i + 1]].tobytes()
+
+    def item(self, i):
+        """Returns the name of item i.
+        """
+        return self.item_name(i).decode('utf-8')
+
+    def item_id(self, name):
+        """Returns the id of a product name, or None if it is not in the snapshot.
+        """
+        key = name.encode('utf-8')
+        low, high = 0, self.n_items
+        while low < high:
+            middle = (low + high) // 2
+            i = self.item_order_view[middle]
+            candidate = self.item_name(i)
+            if candidate < key:
+                low = middle + 1
+            elif candidate > key:
+                high = middle
+            else:
+                return i
+
+        return None
+
+    def recommend(self, userinput):
+        """Returns the also-bought list of a product as [[product, count], ...], or None if
+           the product is not in the snapshot.
+        """
+        self.maybe_reload()
+        i = self.item_id(userinput)
+        if i is None:
+            return None
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+
+        return [[self.item(j), count] for j, count
+                in zip(self.neighbors[start:end].tolist(), self.counts[start:end].tolist())]
@@ -0,0 +1,170 @@
+# !/usr/bin/env python
+
+"""
+author   : Marcelo Sanches
+doc name : Online Retail data loader
+purpose  : to convert the Online Retail dataset once into a typed, compressed Parquet cache
+           and memory-map it, or stream it in chunks, on every later start
+date     : 05.06.2019
+version  : 3.7.2
+"""
+
+# Import modules
+import hashlib
+import json
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# source files, in order of preference, and the cache built from them
+SOURCE_FILES = ['Online Retail.xlsx', 'Online_Retail.csv']
+CACHE_FILE = 'Online_Retail.parquet'
+
+# key of the Parquet schema metadata describing the source the cache was built from
+CACHE_METADATA_KEY = b'retail_source'
+
+# rows per chunk when streaming the data
+CHUNK_ROWS = 50000
+
+
+# Setup functions
+def find_source():
+    """Returns the first Online Retail source file that exists locally.
+    """
+    for path in SOURCE_FILES:
+        if os.path.isfile(path):
+            return path
+
+    raise IOError("Online Retail dataset not found, expected one of " + str(SOURCE_FILES))
+
+def file_hash(path):
+    """Returns the SHA-1 hex digest of a file, read in 1 MB blocks.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+def source_fingerprint(path, with_hash=True):
+    """Describes a source file by name, modification time, size and (optionally) hash.
+    """
+    stat = os.stat(path)
+    fingerprint = {'path': os.path.basename(path),
+                   'mtime_ns': stat.st_mtime_ns,
+                   'size': stat.st_size}
+    if with_hash:
+        fingerprint['sha1'] = file_hash(path)
+
+    return fingerprint
+
+def cached_fingerprint(cache=CACHE_FILE):
+    """Reads the source fingerprint stored in a cache file's footer, or None without a
+       usable cache.
+    """
+    if not os.path.isfile(cache):
+        return None
+    try:
+        metadata = pq.read_schema(cache).metadata or {}
+    except (pa.ArrowInvalid, OSError):
+        return None
+    if CACHE_METADATA_KEY not in metadata:
+        return None
+
+    return json.loads(metadata[CACHE_METADATA_KEY].decode('utf-8'))
+
+def cache_is_fresh(source, cache=CACHE_FILE):
+    """Checks whether the cache was built from the current source file. Modification time
+       and size are compared first; the file is only hashed when they differ, so a touched
+       but unchanged source does not trigger a rebuild.
+    """
+    cached = cached_fingerprint(cache)
+    if cached is None or cached['path'] != os.path.basename(source):
+        return False
+
+    current = source_fingerprint(source, with_hash=False)
+    if cached['mtime_ns'] == current['mtime_ns'] and cached['size'] == current['size']:
+        return True
+
+    return cached['sha1'] == file_hash(source)
+
+def clean_retail(df):
+    """Filters out rows with missing data and gives every column a compact type.
+    """
+    # filter out missing data (~25% CustomerIDs are NA)
+    df = df.dropna()
+
+    return pd.DataFrame({'InvoiceNo': df['InvoiceNo'].astype(str),
+                         'StockCode': df['StockCode'].astype(str).astype('category'),
+                         'Description': df['Description'].astype(str),
+                         'Quantity': df['Quantity'].astype('int32'),
+                         'InvoiceDate': pd.to_datetime(df['InvoiceDate']),
+                         'UnitPrice': df['UnitPrice'].astype('float64'),
+                         'CustomerID': df['CustomerID'].astype('int32'),
+                         'Country': df['Country'].astype(str).astype('category')})
+
+def build_cache(source, cache=CACHE_FILE):
+    """Converts an Online Retail source file into a zstd-compressed Parquet cache, recording
+       the source fingerprint in the file footer. The cache is written to a temporary file
+       and renamed so that readers never see a partial cache.
+    """
+    print("Building " + cache + " from " + source + " (first run only)")
+    if source.endswith('.xlsx'):
+        df = pd.read_excel(source)
+    else:
+        df = pd.read_csv(source, dtype={'InvoiceNo': str, 'StockCode': str})
+
+    table = pa.Table.from_pandas(clean_retail(df), preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[CACHE_METADATA_KEY] = json.dumps(source_fingerprint(source)).encode('utf-8')
+    table = table.replace_schema_metadata(metadata)
+
+    # row groups of one streaming chunk each, so a chunked scan only decodes what it yields
+    tmp = cache + '.tmp'
+    pq.write_table(table, tmp, compression='zstd', row_group_size=CHUNK_ROWS)
+    os.replace(tmp, cache)
+
+def load_retail_data(source=None, cache=CACHE_FILE):
+    """Returns the cleaned Online Retail dataframe, memory-mapping the Parquet cache and
+       rebuilding it first if the source file changed since it was built.
+    """
+    if source is None:
+        try:
+            source = find_source()
+        except IOError:
+            # a cache shipped without its source is used as is
+            if not os.path.isfile(cache):
+                raise
+            return pq.read_table(cache, memory_map=True).to_pandas()
+
+    if not cache_is_fresh(source, cache):
+        build_cache(source, cache)
+
+    return pq.read_table(cache, memory_map=True).to_pandas()
+
+def iter_retail_chunks(source=None, cache=CACHE_FILE, chunk_rows=CHUNK_ROWS):
+    """Yields the cleaned Online Retail rows in chunks of about chunk_rows rows, in file
+       order, so that callers can start before the whole file is read and never hold all of
+       it. A fresh Parquet cache is scanned batch by batch; otherwise a CSV source is read in
+       chunks directly, and an Excel source (which cannot be streamed) is converted first.
+    """
+    if source is None:
+        try:
+            source = find_source()
+        except IOError:
+            if not os.path.isfile(cache):
+                raise
+            source = None
+
+    if source is not None and not cache_is_fresh(source, cache):
+        if source.endswith('.csv'):
+            for chunk in pd.read_csv(source, dtype={'InvoiceNo': str, 'StockCode': str},
+                                     chunksize=chunk_rows):
+                yield clean_retail(chunk)
+            return
+        build_cache(source, cache)
+
+    for batch in pq.ParquetFile(cache, memory_map=True).iter_batches(batch_size=chunk_rows):
+        yield batch.to_pandas()
@@ -9,91 +9,42 @@ version  : 3.7.2
 """
 
 # Import modules 
+import argparse
 import pandas as pd
 import requests 
 import json
 import os
-from elasticsearch import Elasticsearch
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from BasketBuilder import build_baskets, get_timestamp
+from ElasticsearchClient import (esClient, get_client, basket_id, bulk_body, bulk_errors, 
+                                 check_index, delete_index, doc_path, print_es_indices)
+from RetailData import load_retail_data
 
-# Setup functions
-def create_index(index, index_config):
-    """Creates an index in Elasticsearch
-    """
-    r = requests.put("http://elasticsearch:9200/{}".format(index), json=index_config)
-	
-    if r.status_code != 200:
-        print("Error creating index")
-    else:
-        print("Index created")
+# per-thread Elasticsearch clients of the parallel loader
+local = threading.local()
 
-def delete_index(index):
-    """Deletes an index in Elasticsearch
-    """
-    r = requests.delete("http://elasticsearch:9200/{}".format(index))
-    if r.status_code != 200:
-        print("Error deleting index")
-    else:
-        print("Index deleted")
-
-def check_index(index_name):
-    """Checks whether an index exists in Elasticsearch; if not, creates it with the index 
-        configurations specified below.
-    """
-    es_conn = Elasticsearch("http://elasticsearch:9200")
-    res = es_conn.indices.exists(index=index_name)
-    if res == True:
-        print('index exists')
-    else:
-        index_config = {"mappings":
-                            {"basket":
-                                {"properties":
-                                    {"timestamp": {"type": "date"},
-                                     "StockCodes": {"type": "string"},
-                                     "Descriptions": {"type": "string", 
-                                                      "index": "not_analyzed"}
-                                    }
-                                }
-                            }
-                        }
-
-        create_index(index_name, index_config)
-
-def print_es_indices():
-    """Prints to console current Elasticsearch indices.
+# Setup functions
+def transform_msg(msg):
+    """Reshapes a basket into ES-friendly format, replacing InvoiceDate with a timestamp 
+       unless the basket already carries one.
     """
-    r = requests.get("http://elasticsearch:9200/_cat/indices?v")
-    if r.status_code != 200:
-        print("Error listing indices")
-    else:
-        print(r.text)
+    if "timestamp" not in msg:
+        msg["timestamp"] = get_timestamp(msg["InvoiceDate"])
+    msg.pop("InvoiceDate", None)
 
-def get_timestamp(date_element):
-    """Transform InvoiceDate into an Elasticsearch-friendly timestamp in milliseconds.
-    """
-    date = date_element.split()[0]
-    time = date_element.split()[1]
-
-    year = int(date.split('-')[0])
-    month = int(date.split('-')[1])
-    day =  int(date.split('-')[2])
-
-    hours = int(time.split(':')[0])
-    mins = int(time.split(':')[1])
-    secs = int(time.split(':')[2])
-    	
-    return int(pd.Timestamp(year,month,day,hours,mins,secs).timestamp()*1000)
 	
 def ETL_msg(msg):
     """ Extract-Transform-Load messages into Elasticsearch
     """
     # reshape into ES-friendly format
-    msg["timestamp"] = get_timestamp(msg["InvoiceDate"])
-    del msg["InvoiceDate"]
+    transform_msg(msg)
 
-    # fling into ES
-    r = requests.post("http://elasticsearch:9200/recommender_system/basket", json=msg)
+    # fling into ES, under the invoice number so that reloading replaces the basket
+    r = get_client().put(doc_path("recommender_system", basket_id(msg)), msg)
 	
-    if r.status_code != 201:
+    if r.status_code not in (200, 201):
         print(" "*100)
         print("*"*80)
         print("Error sending message: status code " +str(r.status_code))
@@ -102,19 +53,142 @@ def ETL_msg(msg):
         pass
 		
 
+def get_thread_client():
+    """Returns this thread's Elasticsearch client, so that each loader worker keeps its own 
+       connection alive between bulk requests and retries a busy cluster patiently.
+    """
+    if not hasattr(local, "es"):
+        local.es = esClient(retries=8, pool_size=1)
+
+    return local.es
+
+def chunks(baskets, chunk_size):
+    """Splits an iterable of baskets into lists of at most chunk_size baskets.
+    """
+    chunk = []
+    for basket in baskets:
+        chunk.append(basket)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def ETL_chunk(msgs, retries=8, backoff=0.1):
+    """Extract-Transform-Load a chunk of messages into Elasticsearch through the _bulk API, 
+       retrying with exponential backoff while Elasticsearch is busy: the client retries 
+       whole requests answered with 429/503, and baskets rejected one by one with a 429 
+       inside a successful response (a full write queue) are sent again on their own. 
+       Returns the number of baskets indexed and the number rejected.
+    """
+    for msg in msgs:
+        transform_msg(msg)
+
+    indexed = 0
+    failed = 0
+    for attempt in range(retries + 1):
+        try:
+            r = get_thread_client().bulk("/recommender_system/_bulk", 
+                                         bulk_body(msgs, [basket_id(msg) for msg in msgs]))
+        except requests.exceptions.RequestException as e:
+            print("Error sending chunk: " + str(e))
+            return indexed, failed + len(msgs)
+        if r.status_code != 200:
+            print("Error sending chunk: status code " + str(r.status_code))
+            return indexed, failed + len(msgs)
+
+        # count and report rejected baskets without failing the chunk, keeping those 
+        # rejected because Elasticsearch was busy for another attempt
+        errors = bulk_errors(msgs, r.json())
+        indexed += len(msgs) - len(errors)
+        rejected = []
+        for msg, result in errors:
+            if result["status"] == 429 and attempt < retries:
+                rejected.append(msg)
+            else:
+                failed += 1
+                print("Error indexing basket " + str(msg["InvoiceNo"]) + ": " + str(result.get("error")))
+        if not rejected:
+            break
+
+        time.sleep(backoff * 2 ** attempt)
+        msgs = rejected
+
+    return indexed, failed
+
+def get_load_settings(index):
+    """Returns the current refresh interval and number of replicas of an index (of the 
+       first index behind it if it is an alias).
+    """
+    r = get_client().get("/{}/_settings".format(index))
+    settings = list(r.json().values())[0]["settings"]["index"]
+
+    return {"refresh_interval": settings.get("refresh_interval", "1s"),
+            "number_of_replicas": settings.get("number_of_replicas", "1")}
+
+def put_load_settings(index, settings):
+    """Updates the refresh interval and number of replicas of an index.
+    """
+    r = get_client().put("/{}/_settings".format(index), {"index": settings})
+    if r.status_code != 200:
+        print("Error updating index settings")
+
+def parallel_load(index, baskets, workers=4, chunk_size=500):
+    """Indexes baskets through the _bulk API with a pool of worker threads. Refreshing and 
+       replicas are switched off during the load and restored at the end.
+    """
+    settings = get_load_settings(index)
+    put_load_settings(index, {"refresh_interval": "-1", "number_of_replicas": 0})
+
+    indexed = 0
+    errors = 0
+    start = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(ETL_chunk, chunk) for chunk in chunks(baskets, chunk_size)]
+            for i, future in enumerate(as_completed(futures), 1):
+                ok, failed = future.result()
+                indexed += ok
+                errors += failed
+
+                # progress report
+                if i % 10 == 0 or i == len(futures):
+                    print("chunk " + str(i) + "/" + str(len(futures)) + ": " + str(indexed) 
+                          + " baskets indexed, " + str(round(indexed / (time.time() - start), 1)) 
+                          + " docs/sec")
+    finally:
+        put_load_settings(index, settings)
+        get_client().post("/{}/_refresh".format(index))
+
+    elapsed = time.time() - start
+    print("Indexed " + str(indexed) + " baskets (" + str(errors) + " errors) in " 
+          + str(round(elapsed, 1)) + " s, " + str(round(indexed / elapsed, 1)) + " docs/sec")
+
+		
 # Run 
 if __name__ == "__main__":
+
+	# command line options
+	parser = argparse.ArgumentParser(description="Fling the Online Retail baskets into Elasticsearch")
+	parser.add_argument("--parallel", action="store_true",
+	                    help="index baskets in chunks through the _bulk API with a pool of workers")
+	parser.add_argument("--workers", type=int, default=4,
+	                    help="number of parallel loader workers (default: 4)")
+	parser.add_argument("--chunk-size", type=int, default=500,
+	                    help="number of baskets per bulk request (default: 500)")
+	args = parser.parse_args()
 	
 	# Elasticsearch setup
-	r = requests.get("http://elasticsearch:9200")
+	r = get_client().get("/")
 	if r.status_code != 200:
 		print("Error talking to Elasticsearch")
 
 	# Index name 
 	index_name = "recommender_system"	
 
-	# Delete index -- since this is a static filling up of Elasticsearch, re-filling would just 
-	# produce duplicates, in a real production system one would NOT delete the index 
+	# Delete index -- re-filling no longer duplicates baskets (they are indexed under their 
+	# invoice numbers), but a static load starts from a fresh index and mapping; in a real 
+	# production system one would NOT delete the index 
 	delete_index(index_name)	
 
 	# Check whether index exists, if not, create it, then list all indices
@@ -122,55 +196,21 @@ if __name__ == "__main__":
 	print_es_indices()
 
 	# READ DATA 
-	# convert Excel file to CSV if first time 
-	if os.path.isfile('./Online Retail.csv') == True:
-		pass
+	# memory-map the Parquet cache (the Excel file is only converted on first use or when it changes)
+	df = load_retail_data()
+
+	# aggregate rows into one basket per invoice, with timestamps converted for all rows at once
+	baskets = build_baskets(df, timestamps=True)
+
+	# fling chunks of baskets into Elasticsearch in parallel
+	if args.parallel:
+		parallel_load(index_name, baskets, args.workers, args.chunk_size)
+
 	else:
-            df = pd.read_excel("Online Retail.xlsx")
-            # filter out missing data (~25% CustomerIDs are NA)
-            df = df.dropna()
-            # change CustomerID to integer
-            df['CustomerID'] = df['CustomerID'].astype(int)
-            # save as CSV 
-            df.to_csv("Online_Retail.csv", index=False)
-
-	# read in CSV
-	df = pd.read_csv('Online_Retail.csv')
-
-	# group by invoice num
-	invoice_groups = df.groupby('InvoiceNo')
-
-	# iterate over each group (each invoice)
-	for invoice_name, invoice in invoice_groups:
-	
-		basket = {}
-		stockcodes = []
-		descriptions = []
-		quantities = []
-		unitprices = []
-		
-		# iterate over rows in this invoice dataframe
-		for row_index, row in invoice.iterrows():
-		
-			# these fields are the same for each row, so doesn't matter if we keep overwriting
-			basket['InvoiceNo'] = row['InvoiceNo']
-			basket['CustomerID'] = row['CustomerID']
-			basket['InvoiceDate'] = row['InvoiceDate']
-			basket['Country'] = row['Country']
-			
-			# these fields are different for each row, so we append to lists
-			stockcodes.append(row['StockCode'])
-			descriptions.append(row['Description'])
-			quantities.append(row['Quantity'])
-			unitprices.append(row['UnitPrice'])
-			
-		basket['StockCodes'] = stockcodes
-		basket['Descriptions'] = descriptions
-		basket['Quantities'] = quantities
-		basket['UnitPrices'] = unitprices
-
-		# fling each basket into Elasticsearch
-		ETL_msg(basket)
+		for basket in baskets:
+
+			# fling each basket into Elasticsearch
+			ETL_msg(basket)
 
 
 		
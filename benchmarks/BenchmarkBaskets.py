@@ -0,0 +1,121 @@
+# !/usr/bin/env python
+
+"""
+author   : Marcelo Sanches
+doc name : Basket building benchmark
+purpose  : to compare the columnar basket builder with the groupby + iterrows row loop, and
+           the streaming builder with building from the whole dataframe
+date     : 05.06.2019
+version  : 3.7.2
+"""
+
+# Import modules
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from BasketBuilder import build_baskets, stream_baskets
+
+
+# Setup functions
+def build_baskets_iterrows(df):
+    """Builds baskets the way the producer and the static flinger used to, one row at a time.
+    """
+    baskets = []
+    for invoice_name, invoice in df.groupby('InvoiceNo'):
+        basket = {}
+        stockcodes = []
+        descriptions = []
+        quantities = []
+        unitprices = []
+        for row_index, row in invoice.iterrows():
+            basket['InvoiceNo'] = row['InvoiceNo']
+            basket['CustomerID'] = row['CustomerID']
+            basket['InvoiceDate'] = row['InvoiceDate']
+            basket['Country'] = row['Country']
+            stockcodes.append(row['StockCode'])
+            descriptions.append(row['Description'])
+            quantities.append(row['Quantity'])
+            unitprices.append(row['UnitPrice'])
+        basket['StockCodes'] = stockcodes
+        basket['Descriptions'] = descriptions
+        basket['Quantities'] = quantities
+        basket['UnitPrices'] = unitprices
+        baskets.append(basket)
+
+    return baskets
+
+def synthetic_retail(n_invoices, seed=0):
+    """Generates a dataframe shaped like Online_Retail.csv with about 18 rows per invoice.
+    """
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(1, 36, n_invoices)
+    n = int(sizes.sum())
+    products = np.array(["PRODUCT {}".format(i) for i in range(4000)], dtype=object)
+    items = rng.integers(0, len(products), n)
+    invoices = np.repeat(np.arange(536365, 536365 + n_invoices), sizes).astype(str)
+    dates = pd.Timestamp("2010-12-01 08:26:00") + pd.to_timedelta(
+        np.repeat(np.arange(n_invoices) * 1200, sizes), unit="s")
+
+    df = pd.DataFrame({"InvoiceNo": invoices,
+                       "StockCode": (items + 10000).astype(str),
+                       "Description": products[items],
+                       "Quantity": rng.integers(1, 24, n),
+                       "InvoiceDate": dates.strftime("%Y-%m-%d %H:%M:%S"),
+                       "UnitPrice": rng.integers(10, 2000, n) / 100.0,
+                       "CustomerID": np.repeat(rng.integers(12346, 18288, n_invoices), sizes),
+                       "Country": "United Kingdom"})
+
+    # shuffle rows so that invoices are not contiguous
+    return df.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+def timed(function, df):
+    """Runs a basket builder over a dataframe, returning its baskets and elapsed seconds.
+    """
+    start = time.perf_counter()
+    baskets = list(function(df))
+    return baskets, time.perf_counter() - start
+
+
+# Run
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark basket building")
+    parser.add_argument("--csv", default="Online_Retail.csv",
+                        help="Online Retail CSV file, synthetic data is used if it does not exist")
+    parser.add_argument("--invoices", type=int, default=20000,
+                        help="number of synthetic invoices (default: 20000)")
+    parser.add_argument("--chunk-rows", type=int, default=50000,
+                        help="rows per chunk of the streaming builder (default: 50000)")
+    args = parser.parse_args()
+
+    if os.path.isfile(args.csv):
+        df = pd.read_csv(args.csv, dtype={'InvoiceNo': str, 'StockCode': str})
+    else:
+        df = synthetic_retail(args.invoices)
+    print("rows: " + str(len(df)))
+
+    old_baskets, old_time = timed(build_baskets_iterrows, df)
+    new_baskets, new_time = timed(build_baskets, df)
+
+    print("groupby + iterrows : {:8.3f} s  {:10.0f} baskets/sec".format(old_time, len(old_baskets) / old_time))
+    print("columnar builder   : {:8.3f} s  {:10.0f} baskets/sec".format(new_time, len(new_baskets) / new_time))
+    print("speedup            : {:8.1f} x".format(old_time / new_time))
+    print("identical output   : " + str(old_baskets == new_baskets))
+
+    # streaming needs the rows of each invoice together, as they are in the data files
+    df = df.sort_values('InvoiceNo', kind='mergesort').reset_index(drop=True)
+    chunks = (df.iloc[i:i + args.chunk_rows] for i in range(0, len(df), args.chunk_rows))
+    start = time.perf_counter()
+    streamed = stream_baskets(chunks)
+    first = next(streamed)
+    first_time = time.perf_counter() - start
+    stream_baskets_list = [first] + list(streamed)
+    stream_time = time.perf_counter() - start
+
+    print("streaming builder  : {:8.3f} s  {:10.0f} baskets/sec, first basket after {:.1f} ms".format(
+        stream_time, len(stream_baskets_list) / stream_time, first_time * 1000))
+    print("identical output   : " + str(stream_baskets_list == list(build_baskets(df))))
@@ -0,0 +1,86 @@
+# !/usr/bin/env python
+
+"""
+author   : Marcelo Sanches
+doc name : Message codec benchmark
+purpose  : to compare the basket codecs on encoding, decoding, message size and building _bulk
+           bodies from consumed messages
+date     : 05.06.2019
+version  : 3.7.2
+"""
+
+# Import modules
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from BasketBuilder import build_baskets
+from ElasticsearchClient import bulk_body
+from KafkaConsumer import read_msg, transform_msg
+from MessageCodec import CODECS
+from BenchmarkBaskets import synthetic_retail
+from FakeKafka import fakeMessage
+
+
+# Setup functions
+def per_msg(function, items, repeat=3):
+    """Returns the best time of repeat runs of function over items, in microseconds per item.
+    """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(items)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best / len(items) * 1e6
+
+def consume_to_bulk(msgs, batch_size=500):
+    """Builds the _bulk bodies a consumer would send for a list of messages.
+    """
+    for i in range(0, len(msgs), batch_size):
+        docs = [read_msg(msg) for msg in msgs[i:i + batch_size]]
+        for doc in docs:
+            if isinstance(doc, dict):
+                transform_msg(doc)
+        bulk_body(docs)
+
+
+# Run
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the basket codecs")
+    parser.add_argument("--invoices", type=int, default=20000,
+                        help="number of synthetic invoices (default: 20000)")
+    args = parser.parse_args()
+
+    baskets = list(build_baskets(synthetic_retail(args.invoices), timestamps=True))
+    print(str(len(baskets)) + " baskets")
+    print("{:<10} {:>12} {:>12} {:>12} {:>16}".format("codec", "encode us", "decode us",
+                                                     "bytes/msg", "msg->_bulk us"))
+
+    for name, codec in sorted(CODECS.items()):
+        encoded = [codec.encode(basket) for basket in baskets]
+        msgs = [fakeMessage('recommender.system.1', 0, i, None, value, headers)
+                for i, (value, headers) in enumerate(encoded)]
+
+        encode_time = per_msg(lambda items: [codec.encode(basket) for basket in items], baskets)
+        decode_time = per_msg(lambda items: [codec.decode(value) for value, headers in items],
+                              encoded)
+        size = sum(len(value) for value, headers in encoded) / len(encoded)
+        bulk_time = per_msg(consume_to_bulk, msgs)
+
+        print("{:<10} {:>12.2f} {:>12.2f} {:>12.0f} {:>16.2f}".format(name, encode_time, decode_time,
+                                                                     size, bulk_time))
+
+    # the consumer path of the old producer: headerless JSON with an InvoiceDate string
+    legacy = []
+    for i, basket in enumerate(baskets):
+        basket = dict(basket)
+        basket['InvoiceDate'] = time.strftime('%Y-%m-%d %H:%M:%S',
+                                              time.gmtime(basket.pop('timestamp') / 1000))
+        legacy.append(fakeMessage('recommender.system.1', 0, i, None,
+                                  CODECS['ujson'].dumps(basket), None))
+    print("{:<10} {:>12} {:>12} {:>12} {:>16.2f}".format("legacy", "-", "-", "-",
+                                                         per_msg(consume_to_bulk, legacy)))
@@ -0,0 +1,117 @@
+# !/usr/bin/env python
+
+"""
+author   : Marcelo Sanches
+doc name : Index mapping benchmark
+purpose  : to compare significant_terms latency and index size between a dynamically mapped
+           basket index and one using the keyword mapping of the basket template
+date     : 05.06.2019
+version  : 3.7.2
+"""
+
+# Import modules
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from BasketBuilder import build_baskets
+from ElasticsearchClient import (BASKET_MAPPING, basket_id, bulk_body, create_index, delete_index,
+                                 get_client)
+from QueryElasticsearch import queryType
+from BenchmarkBaskets import synthetic_retail
+
+
+# Setup functions
+def aggregation_query(product, field):
+    """Returns the recommendation query of a product, run on the given description field.
+    """
+    query = queryType(product, window=None, sampler=None).query_descriptions()
+    query["query"]["bool"]["filter"][0]["term"] = {field: product}
+    query["aggs"]["correlated_words"]["significant_terms"]["field"] = field
+
+    return query
+
+def load(index, baskets, chunk_size=1000):
+    """Bulk-indexes baskets and merges the index down to one segment, so that sizes compare.
+    """
+    es = get_client()
+    for i in range(0, len(baskets), chunk_size):
+        chunk = baskets[i:i + chunk_size]
+        es.bulk('/{}/_bulk'.format(index), bulk_body(chunk, [basket_id(basket) for basket in chunk]))
+    es.post('/{}/_refresh'.format(index))
+    es.post('/{}/_forcemerge'.format(index), params={'max_num_segments': 1})
+    es.post('/{}/_refresh'.format(index))
+
+def store_size_mb(index):
+    stats = get_client().get('/{}/_stats/store,docs'.format(index)).json()["_all"]["primaries"]
+    return stats["store"]["size_in_bytes"] / 1024.0 ** 2, stats["docs"]["count"]
+
+def search_time(index, query):
+    """Returns the latency of a search in milliseconds, bypassing the shard request cache.
+    """
+    start = time.perf_counter()
+    r = get_client().request('POST', '/{}/_search'.format(index), query,
+                             params={'request_cache': 'false'})
+    elapsed = (time.perf_counter() - start) * 1000
+    if r.status_code != 200:
+        raise Exception("Search failed on " + index + ": " + r.text)
+
+    return elapsed
+
+def after_refresh_time(index, baskets, query):
+    """Indexes a few more baskets, refreshes, and times the first aggregation that follows,
+       which pays for building global ordinals unless they are eager.
+    """
+    es = get_client()
+    es.bulk('/{}/_bulk'.format(index), bulk_body(baskets, [basket_id(basket) + '-new'
+                                                           for basket in baskets]))
+    es.post('/{}/_refresh'.format(index))
+
+    return search_time(index, query)
+
+
+# Run
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the basket mapping against dynamic mapping "
+                                                 "on the Elasticsearch cluster in ES_HOSTS")
+    parser.add_argument("--invoices", type=int, default=50000,
+                        help="number of synthetic invoices to index (default: 50000)")
+    parser.add_argument("--queries", type=int, default=200,
+                        help="recommendation queries per index (default: 200)")
+    parser.add_argument("--keep", action="store_true", help="keep the benchmark indices")
+    args = parser.parse_args()
+
+    baskets = list(build_baskets(synthetic_retail(args.invoices), timestamps=True))
+    counts = {}
+    for basket in baskets:
+        for product in basket["Descriptions"]:
+            counts[product] = counts.get(product, 0) + 1
+    products = sorted(counts, key=counts.get, reverse=True)[:50]
+
+    # before: mapped dynamically, descriptions become text with a keyword subfield
+    # after: the template's keyword mapping with eager global ordinals
+    variants = [("bench_baskets_dynamic", None, "Descriptions.keyword"),
+                ("bench_baskets_keyword", {"mappings": BASKET_MAPPING}, "Descriptions")]
+
+    print("{:<24} {:>8} {:>10} {:>10} {:>10} {:>16}".format("index", "docs", "size MB", "p50 ms",
+                                                             "p99 ms", "after refresh ms"))
+    for index, config, field in variants:
+        delete_index(index)
+        create_index(index, config or {})
+        load(index, baskets[:-100])
+
+        latencies = [search_time(index, aggregation_query(products[i % len(products)], field))
+                     for i in range(args.queries)]
+        refresh_latency = after_refresh_time(index, baskets[-100:],
+                                             aggregation_query(products[0], field))
+        size, docs = store_size_mb(index)
+
+        print("{:<24} {:>8} {:>10.1f} {:>10.2f} {:>10.2f} {:>16.2f}".format(
+            index, docs, size, np.percentile(latencies, 50), np.percentile(latencies, 99),
+            refresh_latency))
+
+        if not args.keep:
+            delete_index(index)
@@ -0,0 +1,165 @@
+# !/usr/bin/env python
+
+"""
+author   : Marcelo Sanches
+doc name : End-to-end pipeline benchmark
+purpose  : to measure the throughput of every stage of the pipeline - basket building, producing,
+           timestamp parsing, consumer ETL, bulk indexing and querying - against in-process Kafka
+           and Elasticsearch stand-ins, at several data scales
+date     : 05.06.2019
+version  : 3.7.2
+"""
+
+# Import modules
+import argparse
+import contextlib
+import os
+import random
+import resource
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ElasticsearchClient
+from BasketBuilder import build_baskets, get_timestamp
+from ElasticsearchClient import esClient
+from KafkaConsumer import ETL_msg, basketBatcher
+from KafkaProducer import produce_basket
+from QueryElasticsearch import execute_es_query, queryCache, queryType
+from RetailData import load_retail_data
+from BenchmarkBaskets import synthetic_retail
+from FakeKafka import fakeConsumer, fakeProducer
+from StubElasticsearch import run_stub_in_thread
+
+
+# Setup functions
+def peak_rss_mb():
+    """Returns the peak resident set size of the process so far, in MB (ru_maxrss is in KB
+       on Linux).
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def scaled_retail(base, scale):
+    """Repeats a retail dataframe scale times, giving each copy its own invoice numbers.
+    """
+    if scale == 1:
+        return base
+    copies = []
+    for i in range(scale):
+        copy = base.copy()
+        copy['InvoiceNo'] = copy['InvoiceNo'].astype(str) + '-' + str(i)
+        copies.append(copy)
+
+    return pd.concat(copies, ignore_index=True)
+
+def report(stage, n, elapsed, latencies=None):
+    """Prints the throughput of a stage, its latency percentiles if it made requests, and
+       the peak RSS so far.
+    """
+    line = "  {:<22} {:>9} msgs {:>11.0f} msgs/sec".format(stage, n, n / elapsed)
+    if latencies:
+        latencies = np.array(latencies) * 1000
+        line += "   p50 {:7.2f} ms  p99 {:7.2f} ms".format(np.percentile(latencies, 50),
+                                                           np.percentile(latencies, 99))
+    print(line + "   peak RSS {:7.1f} MB".format(peak_rss_mb()))
+
+def run_scale(base, scale, max_requests, batch_size, products):
+    """Runs every stage over the base data repeated scale times.
+    """
+    df = scaled_retail(base, scale)
+    print("scale x" + str(scale) + ": " + str(len(df)) + " rows")
+
+    # producer side: basket building, then serializing and producing every basket
+    start = time.perf_counter()
+    baskets = list(build_baskets(df, timestamps=True))
+    report("build baskets", len(baskets), time.perf_counter() - start)
+
+    producer = fakeProducer()
+    start = time.perf_counter()
+    for basket in baskets:
+        produce_basket(producer, 'recommender.system.1', basket)
+    producer.flush()
+    report("produce", len(baskets), time.perf_counter() - start)
+
+    # timestamp parsing of one date per basket, from a cold cache as in a freshly started
+    # consumer
+    dates = df.drop_duplicates('InvoiceNo')['InvoiceDate']
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        dates = dates.dt.strftime('%Y-%m-%d %H:%M:%S')
+    dates = dates.astype(str).tolist()
+    get_timestamp.cache_clear()
+    start = time.perf_counter()
+    for date in dates:
+        get_timestamp(date)
+    report("get_timestamp", len(dates), time.perf_counter() - start)
+
+    # consumer side: one request per basket, then _bulk batches with offset commits
+    sample = [dict(basket) for basket in baskets[:max_requests]]
+    latencies = []
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for msg in sample:
+            t = time.perf_counter()
+            ETL_msg(msg)
+            latencies.append(time.perf_counter() - t)
+    report("ETL_msg", len(sample), time.perf_counter() - start, latencies)
+
+    consumer = fakeConsumer(producer)
+    batcher = basketBatcher(consumer, batch_size, linger_ms=0, report=False)
+    latencies = []
+    start = time.perf_counter()
+    while consumer.remaining():
+        for msg in consumer.consume(batch_size):
+            batcher.add(msg)
+        t = time.perf_counter()
+        batcher.flush()
+        latencies.append(time.perf_counter() - t)
+    report("ETL_bulk", batcher.docs_indexed, time.perf_counter() - start, latencies)
+
+    # query side: significant_terms queries for popular products, through the cache
+    cache = queryCache()
+    latencies = []
+    start = time.perf_counter()
+    for i in range(max_requests):
+        product = random.choice(products)
+        t = time.perf_counter()
+        execute_es_query('recommender_system', queryType(product).query_descriptions(), product,
+                         cache)
+        latencies.append(time.perf_counter() - t)
+    report("execute_es_query", max_requests, time.perf_counter() - start, latencies)
+    print("  query cache hit rate   {:.1%}".format(cache.stats()['hit_rate']))
+
+
+# Run
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline end to end against "
+                                                 "in-process Kafka and Elasticsearch stand-ins")
+    parser.add_argument("--data", action="store_true",
+                        help="use the Online Retail data instead of synthetic invoices")
+    parser.add_argument("--invoices", type=int, default=2000,
+                        help="number of synthetic invoices at scale 1 (default: 2000)")
+    parser.add_argument("--scales", type=int, nargs='+', default=[1, 10, 100],
+                        help="data scales to run (default: 1 10 100)")
+    parser.add_argument("--max-requests", type=int, default=2000,
+                        help="requests sent by the per-basket ETL and query stages (default: 2000)")
+    parser.add_argument("--batch-size", type=int, default=500,
+                        help="baskets per _bulk request (default: 500)")
+    parser.add_argument("--es-latency-ms", type=float, default=1,
+                        help="latency of the stub Elasticsearch (default: 1)")
+    parser.add_argument("--es-port", type=int, default=9298)
+    args = parser.parse_args()
+
+    stub = run_stub_in_thread(args.es_latency_ms / 1000.0, port=args.es_port)
+    ElasticsearchClient.shared_client = esClient(['http://127.0.0.1:' + str(args.es_port)])
+
+    base = load_retail_data() if args.data else synthetic_retail(args.invoices)
+
+    # popular products are queried most, as in the query tool
+    counts = base['Description'].value_counts()
+    products = [str(product) for product in counts.index[:200]]
+
+    for scale in args.scales:
+        run_scale(base, scale, args.max_requests, args.batch_size, products)
+    print("stub Elasticsearch requests: " + str(stub.requests))
@@ -0,0 +1,108 @@
+# !/usr/bin/env python
+
+"""
+author   : Marcelo Sanches
+doc name : Query mode benchmark
+purpose  : to compare the latency and the recommendations of time-windowed and sampled
+           significant_terms queries with those of the full-history query
+date     : 05.06.2019
+version  : 3.7.2
+"""
+
+# Import modules
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ElasticsearchClient import get_client
+from QueryElasticsearch import correlated_buckets, queryType
+
+
+# Setup functions
+def popular_products(index, n):
+    """Returns the n products found in the most baskets and the latest basket timestamp.
+    """
+    query = {"size": 0,
+             "aggs": {"popular": {"terms": {"field": "Descriptions", "size": n}},
+                      "latest": {"max": {"field": "timestamp"}}}}
+    res = get_client().search(index, query)
+    if res is None:
+        raise Exception("Could not read the products of " + index)
+
+    return ([bucket["key"] for bucket in res["aggregations"]["popular"]["buckets"]],
+            res["aggregations"]["latest"]["value"])
+
+def timed_search(index, query):
+    """Returns the latency of a search in milliseconds, bypassing the shard request cache,
+       and the recommended products.
+    """
+    start = time.perf_counter()
+    r = get_client().request('POST', '/{}/_search'.format(index), query,
+                             params={'request_cache': 'false'})
+    elapsed = (time.perf_counter() - start) * 1000
+    if r.status_code != 200:
+        raise Exception("Search failed on " + index + ": " + r.text)
+
+    return elapsed, [bucket['key'] for bucket in correlated_buckets(r.json())]
+
+def query_modes(windows, shard_sizes):
+    """Returns the query options of every mode to compare, the full history first.
+    """
+    modes = [("full history", {})]
+    modes += [("window " + window, {"window": window}) for window in windows]
+    modes += [("sampler " + str(size), {"sampler": "sampler", "shard_size": size})
+              for size in shard_sizes]
+    modes += [("diversified " + str(size), {"sampler": "diversified", "shard_size": size})
+              for size in shard_sizes]
+    if windows and shard_sizes:
+        modes.append(("window " + windows[-1] + " + sampler " + str(shard_sizes[-1]),
+                      {"window": windows[-1], "sampler": "sampler", "shard_size": shard_sizes[-1]}))
+
+    return modes
+
+
+# Run
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark windowed and sampled recommendation queries "
+                                                 "on the Elasticsearch cluster in ES_HOSTS")
+    parser.add_argument("--index", default="recommender_system",
+                        help="basket index or alias (default: recommender_system)")
+    parser.add_argument("--products", type=int, default=100,
+                        help="number of popular products queried per mode (default: 100)")
+    parser.add_argument("--windows", nargs="*", default=["30d", "90d", "180d"],
+                        help="time windows before the latest basket (default: 30d 90d 180d)")
+    parser.add_argument("--shard-sizes", type=int, nargs="*", default=[100, 500, 2000],
+                        help="sampler shard sizes (default: 100 500 2000)")
+    parser.add_argument("--min-doc-count", type=int, default=10,
+                        help="minimum number of shared baskets (default: 10)")
+    parser.add_argument("--size", type=int, default=10,
+                        help="recommendations per product (default: 10)")
+    args = parser.parse_args()
+
+    products, latest = popular_products(args.index, args.products)
+    print("{} products, latest basket at {}".format(len(products), latest))
+
+    # overlap is the share of the full-history recommendations a mode also returns
+    print("{:<28} {:>10} {:>10} {:>10} {:>10}".format("mode", "p50 ms", "p99 ms", "overlap",
+                                                       "empty"))
+    reference = {}
+    for name, options in query_modes(args.windows, args.shard_sizes):
+        options = dict({"window": None, "sampler": None}, **options)
+        latencies, overlaps, empty = [], [], 0
+        for product in products:
+            query = queryType(product, end=latest, min_doc_count=args.min_doc_count,
+                              size=args.size, **options).query_descriptions()
+            latency, items = timed_search(args.index, query)
+            latencies.append(latency)
+            empty += not items
+            if not options["window"] and not options["sampler"]:
+                reference[product] = items
+            if reference.get(product):
+                overlaps.append(len(set(items) & set(reference[product])) / len(reference[product]))
+
+        print("{:<28} {:>10.2f} {:>10.2f} {:>10.0%} {:>10.0%}".format(
+            name, np.percentile(latencies, 50), np.percentile(latencies, 99),
+            np.mean(overlaps) if overlaps else 0.0, empty / len(products)))
@@ -0,0 +1,98 @@
+# !/usr/bin/env python
+
+"""
+author   : Marcelo Sanches
+doc name : Recommendation service load test
+purpose  : to measure the latency percentiles and throughput of the recommendation service
+           against a stub Elasticsearch
+date     : 05.06.2019
+version  : 3.7.2
+"""
+
+# Import modules
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+import aiohttp
+import numpy as np
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from RecommendationService import recommendationService, make_app
+from StubElasticsearch import PRODUCTS, start_stub
+
+
+# Setup functions
+async def client(session, url, paths, deadline, latencies, errors):
+    """Sends requests one after another until the deadline, recording each latency.
+    """
+    while time.time() < deadline:
+        path = random.choice(paths)
+        start = time.perf_counter()
+        async with session.get(url + path) as r:
+            await r.read()
+            if r.status != 200:
+                errors.append(r.status)
+        latencies.append(time.perf_counter() - start)
+
+async def load_test(endpoint, concurrency, duration, hot_products, es_latency, es_port, port):
+    """Runs the stub and the service on this event loop and drives them with concurrency
+       clients for duration seconds. Returns the latencies, errors and service statistics.
+    """
+    stub, stub_runner = await start_stub(es_latency, port=es_port)
+    service = recommendationService(hosts=['http://127.0.0.1:' + str(es_port)])
+    runner = web.AppRunner(make_app(service))
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+
+    # a few hot products get most of the traffic, as on a real storefront
+    if endpoint == 'recommend':
+        paths = ['/recommend?item=' + product.replace(' ', '+')
+                 for product in PRODUCTS[:hot_products]]
+    else:
+        await asyncio.sleep(0.5)
+        paths = ['/suggest?q=' + product[-3:] for product in PRODUCTS[:hot_products]]
+
+    latencies = []
+    errors = []
+    deadline = time.time() + duration
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[client(session, 'http://127.0.0.1:' + str(port), paths, deadline,
+                                      latencies, errors)
+                               for i in range(concurrency)])
+
+    await runner.cleanup()
+    await stub_runner.cleanup()
+
+    return latencies, errors, service, stub
+
+
+# Run
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the recommendation service")
+    parser.add_argument("--endpoint", choices=['recommend', 'suggest'], default='recommend')
+    parser.add_argument("--concurrency", type=int, default=50, help="concurrent clients (default: 50)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run (default: 10)")
+    parser.add_argument("--hot-products", type=int, default=20,
+                        help="distinct products requested (default: 20)")
+    parser.add_argument("--es-latency-ms", type=float, default=20,
+                        help="latency of the stub Elasticsearch (default: 20)")
+    parser.add_argument("--es-port", type=int, default=9299)
+    parser.add_argument("--port", type=int, default=8099)
+    args = parser.parse_args()
+
+    latencies, errors, service, stub = asyncio.run(load_test(
+        args.endpoint, args.concurrency, args.duration, args.hot_products,
+        args.es_latency_ms / 1000.0, args.es_port, args.port))
+
+    latencies = np.array(latencies) * 1000
+    print("requests          : " + str(len(latencies)) + " (" + str(len(errors)) + " errors)")
+    print("throughput        : " + str(round(len(latencies) / args.duration, 1)) + " req/sec")
+    print("latency p50 / p99 : " + str(round(np.percentile(latencies, 50), 2)) + " / "
+          + str(round(np.percentile(latencies, 99), 2)) + " ms")
+    print("ES searches       : " + str(stub.requests.get('_search', 0))
+          + " (" + str(service.coalesced_requests) + " requests coalesced)")
@@ -0,0 +1,184 @@
+# !/usr/bin/env python
+
+"""
+author   : Marcelo Sanches
+doc name : Stub Elasticsearch
+purpose  : to answer the indexing requests and searches the recommender sends with canned
+           responses and a configurable latency, so the pipeline and the services can be
+           benchmarked without a cluster
+date     : 05.06.2019
+version  : 3.7.2
+"""
+
+# Import modules
+import asyncio
+import threading
+import time
+import zlib
+import ujson
+from aiohttp import web
+
+# products the stub knows about, returned by vocabulary sweeps and as recommendations
+PRODUCTS = ["PRODUCT {:04d}".format(i) for i in range(2000)]
+
+
+# Setup classes
+class stubElasticsearch():
+    """This class answers single-document indexing, _bulk, _search (significant_terms and
+       composite aggregations), _count and _stats requests, sleeping latency seconds before
+       each answer and counting the requests it receives by endpoint. Indexed documents are
+       counted by id, not stored.
+    """
+
+    def __init__(self, latency=0.005, buckets=10):
+        self.latency = latency
+        self.buckets = buckets
+        self.requests = {}
+        self.docs = 0
+        self.ids = set()
+
+    def count(self, endpoint):
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def significant_terms(self, query):
+        """Returns buckets of products chosen deterministically from the filtered product.
+        """
+        product = query["query"]["bool"]["filter"][0]["term"]["Descriptions"]
+        first = zlib.crc32(product.encode('utf-8'))
+        return [{"key": PRODUCTS[(first + i * 7919) % len(PRODUCTS)], "doc_count": 100 - i,
+                 "score": 1.0 / (i + 1), "bg_count": 1000}
+                for i in range(self.buckets)]
+
+    def composite(self, query):
+        """Returns one page of the product vocabulary, after the requested key.
+        """
+        composite = query["aggs"]["products"]["composite"]
+        after = composite.get("after", {}).get("description")
+        start = 0 if after is None else PRODUCTS.index(after) + 1
+        page = PRODUCTS[start:start + composite["size"]]
+        aggs = {"products": {"buckets": [{"key": {"description": product}, "doc_count": 1}
+                                         for product in page]}}
+        if page:
+            aggs["products"]["after_key"] = {"description": page[-1]}
+        if "latest" in query["aggs"]:
+            aggs["latest"] = {"value": 1291161600000}
+            aggs["indexed"] = {"value": int(time.time() * 1000)}
+
+        return aggs
+
+    async def search(self, request):
+        self.count('_search')
+        query = await request.json()
+        await asyncio.sleep(self.latency)
+
+        aggs = {}
+        if "correlated_words" in query.get("aggs", {}):
+            aggs["correlated_words"] = {"doc_count": 1000,
+                                        "buckets": self.significant_terms(query)}
+        elif "sample" in query.get("aggs", {}):
+            aggs["sample"] = {"doc_count": 1000,
+                              "correlated_words": {"doc_count": 1000,
+                                                   "buckets": self.significant_terms(query)}}
+        elif "products" in query.get("aggs", {}):
+            aggs = self.composite(query)
+        elif "latest" in query.get("aggs", {}):
+            aggs["latest"] = {"value": 1291161600000}
+
+        return web.json_response({"took": int(self.latency * 1000), "timed_out": False,
+                                  "hits": {"total": len(PRODUCTS), "hits": []},
+                                  "aggregations": aggs})
+
+    async def count_docs(self, request):
+        self.count('_count')
+        return web.json_response({"count": len(PRODUCTS)})
+
+    def store(self, doc_id):
+        """Counts a document under its id (a new id if none), returning whether it is new.
+        """
+        self.docs += 1
+        doc_id = doc_id or 'auto-' + str(self.docs)
+        created = doc_id not in self.ids
+        self.ids.add(doc_id)
+
+        return doc_id, created
+
+    async def index_doc(self, request):
+        self.count('_doc')
+        await request.read()
+        await asyncio.sleep(self.latency)
+        doc_id, created = self.store(request.match_info.get('id'))
+
+        return web.json_response({"_index": request.match_info['index'], "_id": doc_id,
+                                  "result": "created" if created else "updated"},
+                                 status=201 if created else 200)
+
+    async def bulk(self, request):
+        """Acknowledges every action of a _bulk body (one action line, one source line each).
+        """
+        self.count('_bulk')
+        lines = (await request.read()).splitlines()
+        await asyncio.sleep(self.latency)
+
+        items = []
+        for action in lines[0::2]:
+            op, meta = list(ujson.loads(action).items())[0]
+            doc_id, created = self.store(meta.get('_id'))
+            items.append({op: {"_id": doc_id, "status": 201 if created else 200,
+                               "result": "created" if created else "updated"}})
+
+        return web.json_response({"took": int(self.latency * 1000), "errors": False,
+                                  "items": items})
+
+    async def stats(self, request):
+        self.count('_stats')
+        return web.json_response({"_all": {"primaries": {"docs": {"count": len(self.ids),
+                                                                  "deleted": 0},
+                                                         "indexing": {"index_total": self.docs}}}})
+
+    async def root(self, request):
+        return web.json_response({"version": {"number": "stub"}})
+
+    def make_app(self):
+        # bodies arrive gzip-compressed and are decompressed by aiohttp
+        app = web.Application(client_max_size=1024**3)
+        app.router.add_get('/', self.root)
+        app.router.add_route('*', '/{index}/_search', self.search)
+        app.router.add_route('*', '/{index}/_count', self.count_docs)
+        app.router.add_route('*', '/{index}/_stats/{metrics}', self.stats)
+        app.router.add_post('/{index}/_bulk', self.bulk)
+        app.router.add_post('/{index}/{type}/_bulk', self.bulk)
+        app.router.add_post('/{index}/{type}', self.index_doc)
+        app.router.add_put('/{index}/{type}/{id}', self.index_doc)
+
+        return app
+
+
+# Setup functions
+async def start_stub(latency=0.005, host='127.0.0.1', port=9200):
+    """Starts a stub Elasticsearch on the running event loop and returns it with its runner.
+    """
+    stub = stubElasticsearch(latency)
+    runner = web.AppRunner(stub.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    return stub, runner
+
+def run_stub_in_thread(latency=0.005, host='127.0.0.1', port=9200):
+    """Starts a stub Elasticsearch on its own event loop in a daemon thread, for benchmarks
+       of blocking code, and returns it once it is listening.
+    """
+    ready = threading.Event()
+    started = {}
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        started['stub'], runner = loop.run_until_complete(start_stub(latency, host, port))
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    ready.wait()
+
+    return started['stub']